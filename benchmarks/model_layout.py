@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""Memory per instance and attribute access speed of dict-backed and
+compact (_compact = True) models.
+
+    python benchmarks/model_layout.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyorm.model import Model, Property
+
+class Ticket(Model):
+    _table_name = 'ticket'
+    _key = 'id'
+    id = Property()
+    state = Property()
+    subject = Property()
+    assigned = Property()
+    priority = Property(default=3)
+
+class CompactTicket(Model):
+    _compact = True
+    _table_name = 'ticket'
+    _key = 'id'
+    id = Property()
+    state = Property()
+    subject = Property()
+    assigned = Property()
+    priority = Property(default=3)
+
+def instance_size(model):
+    """Bytes used by the instance and its containers, values excluded"""
+    size = sys.getsizeof(model)
+    if hasattr(model, '__dict__'):
+        size += sys.getsizeof(model.__dict__) + sys.getsizeof(model.data)
+    else:
+        size += sys.getsizeof(model._values)
+    return size
+
+def make(cls, i):
+    model = cls(None, id=i, state=u'Open', subject=u'subject', assigned=u'usr1', priority=3)
+    model.saved = True
+    return model
+
+def run(number=200000):
+    results = {}
+    for cls in (Ticket, CompactTicket):
+        model = make(cls, 1)
+        get = timeit.Timer('m.subject', 'from __main__ import make, %s; m = make(%s, 1)' % (cls.__name__, cls.__name__))
+        set = timeit.Timer('m.subject = 1', 'from __main__ import make, %s; m = make(%s, 1)' % (cls.__name__, cls.__name__))
+        create = timeit.Timer('make(%s, 1)' % cls.__name__, 'from __main__ import make, %s' % cls.__name__)
+        load = timeit.Timer('load(None, row)', 'from __main__ import %s; load = %s._meta.loader(); '
+                'row = (u"usr1", 1, 3, u"Open", u"subject")' % (cls.__name__, cls.__name__))
+        results[cls.__name__] = dict(
+            bytes=instance_size(model),
+            get_ns=min(get.repeat(3, number)) / number * 1e9,
+            set_ns=min(set.repeat(3, number)) / number * 1e9,
+            create_ns=min(create.repeat(3, number / 10)) / (number / 10) * 1e9,
+            load_ns=min(load.repeat(3, number / 10)) / (number / 10) * 1e9,
+        )
+    return results
+
+if __name__ == '__main__':
+    print '%-15s %10s %10s %10s %10s %10s' % ('model', 'bytes', 'get ns', 'set ns', 'create ns', 'load ns')
+    for name, res in sorted(run().items()):
+        print '%-15s %10d %10.0f %10.0f %10.0f %10.0f' % (name, res['bytes'], res['get_ns'], res['set_ns'],
+                res['create_ns'], res['load_ns'])
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+"""Benchmarks of memory_datasource and pg_datasource.
+
+    python benchmarks/run.py --rows 100000 --output new.json
+    python benchmarks/run.py --datasource pg --dsn "dbname=pyorm_test" --rows 1000000
+    python benchmarks/run.py --compare old.json new.json --threshold 0.1
+
+A synthetic dataset of --rows tickets (plus rows/10 users and rows/5 group
+members) is loaded with save_many, then every case runs --ops operations.
+For each case the JSON report holds the throughput (ops per second),
+latency percentiles in milliseconds and the peak RSS of the process in KB
+after the case. pg runs in the pyorm_bench schema, which is recreated.
+--compare prints the cases whose p50 latency or throughput got worse by
+more than --threshold and exits with status 1 if there are any.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import resource
+import platform
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test.test_base import User, GroupMember, Ticket
+
+states = ['Open', 'Hold', 'Spam', 'Closed']
+
+def make_users(ds, count):
+    return [User(ds, username=u'usr%d' % i, full_name=u'user %d' % i, email=u'usr%d@example.com' % i,
+            department=u'dep%d' % (i % 10)) for i in xrange(count)]
+
+def make_members(ds, count, users):
+    return [GroupMember(ds, username=u'usr%d' % (i % users), groupname=u'gr%d' % (i % 50))
+            for i in xrange(count)]
+
+def make_tickets(ds, start, count, users):
+    opened = datetime(2011, 1, 1)
+    return [Ticket(ds, id=i, state=states[i % 4], subject=u'subject %d' % i, assigned=u'usr%d' % (i % users),
+            date_opened=opened + timedelta(minutes=i), priority=i % 5) for i in xrange(start, start + count)]
+
+def populate(ds, rows):
+    users = max(1, rows / 10)
+    ds.save_many(make_users(ds, users))
+    ds.save_many(make_members(ds, max(1, rows / 5), users))
+    for start in xrange(0, rows, 10000):
+        ds.save_many(make_tickets(ds, start, min(10000, rows - start), users))
+    ds.commit()
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def timed(fn, args_list):
+    """Run fn(*args) for each args, return the report of the case"""
+    latencies = []
+    start = time.time()
+    for args in args_list:
+        t = time.time()
+        fn(*args)
+        latencies.append(time.time() - t)
+    total = time.time() - start
+    latencies.sort()
+    return dict(
+        ops=len(latencies),
+        ops_per_sec=len(latencies) / max(total, 1e-9),
+        p50=percentile(latencies, 0.5) * 1000,
+        p90=percentile(latencies, 0.9) * 1000,
+        p99=percentile(latencies, 0.99) * 1000,
+        max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+def run_cases(ds, rows, ops, seed=1):
+    rnd = random.Random(seed)
+    users = max(1, rows / 10)
+    results = {}
+    ids = [(rnd.randrange(rows),) for i in xrange(ops)]
+    results['get'] = timed(lambda key: Ticket.get(ds, key), ids)
+    new = [(t,) for t in make_tickets(ds, rows, ops, users)]
+    results['insert'] = timed(lambda t: t.save(), new)
+    ds.commit()
+    tickets = [(Ticket.get(ds, key), i) for i, (key,) in enumerate(ids)]
+    def update(ticket, i):
+        ticket.subject = u'changed %d' % i
+        ticket.save()
+    results['update'] = timed(update, tickets)
+    ds.commit()
+    assigned = [(u'usr%d' % rnd.randrange(users),) for i in xrange(ops)]
+    results['filter_order'] = timed(lambda user: Ticket.query(ds).filter('assigned', user).order('-date_opened').fetch(20),
+            assigned)
+    results['count'] = timed(lambda state: Ticket.query(ds).filter('state', state).count(),
+            [(states[i % 4],) for i in xrange(ops)])
+    results['hydrate'] = timed(lambda: len(Ticket.query(ds).fetch(min(rows, 10000))), [()] * max(1, ops / 100))
+    results['hydrate']['rows_per_sec'] = results['hydrate']['ops_per_sec'] * min(rows, 10000)
+    results['query_update'] = timed(lambda user: Ticket.query(ds).filter('assigned', user).update({'priority': 9}),
+            assigned[:max(1, ops / 10)])
+    ds.commit()
+    results['delete'] = timed(lambda t: t.delete(), new)
+    ds.commit()
+    return results
+
+def memory_dataset(options):
+    from pyorm.memory_datasource import DataSet
+    return DataSet()
+
+def pg_dataset(options):
+    import psycopg2
+    import psycopg2.extensions as ex
+    from pyorm.pg_datasource import DataSet
+    from test.test_pg_datasource import create_schema
+    ex.register_type(ex.UNICODE)
+    ex.register_adapter(list, ex.SQL_IN)
+    con = psycopg2.connect(options.dsn)
+    con.set_client_encoding('utf8')
+    ds = DataSet(con, 'pyorm_bench')
+    if ds.execute('select 1 from pg_namespace where nspname=%s', ('pyorm_bench',)).fetchone():
+        ds.execute('drop schema pyorm_bench cascade')
+    ds.execute(create_schema('pyorm_bench'))
+    ds.execute('create index ticket_id on pyorm_bench.ticket (id)')
+    ds.execute('create index ticket_assigned on pyorm_bench.ticket (assigned, date_opened)')
+    ds.commit()
+    return ds
+
+datasets = {
+    'memory': memory_dataset,
+    'pg': pg_dataset,
+}
+
+def run(options):
+    report = dict(
+        meta=dict(rows=options.rows, ops=options.ops, python=platform.python_version(),
+                  date=datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        results={},
+    )
+    for name in options.datasource:
+        ds = datasets[name](options)
+        start = time.time()
+        populate(ds, options.rows)
+        results = run_cases(ds, options.rows, options.ops)
+        results['populate'] = dict(ops=options.rows, seconds=time.time() - start)
+        report['results'][name] = results
+    return report
+
+def compare(old, new, threshold):
+    """[(datasource, case, metric, old value, new value)] of regressions"""
+    res = []
+    for name, cases in new['results'].iteritems():
+        for case, entry in cases.iteritems():
+            before = old['results'].get(name, {}).get(case)
+            if before is None:
+                continue
+            if 'p50' in entry and entry['p50'] > before['p50'] * (1 + threshold):
+                res.append((name, case, 'p50', before['p50'], entry['p50']))
+            if 'ops_per_sec' in entry and entry['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+                res.append((name, case, 'ops_per_sec', before['ops_per_sec'], entry['ops_per_sec']))
+    return res
+
+def main():
+    parser = OptionParser(usage='%prog [options] | %prog --compare OLD NEW')
+    parser.add_option('--datasource', action='append', choices=sorted(datasets),
+                      help='memory or pg, may be repeated (default memory)')
+    parser.add_option('--rows', type='int', default=1000, help='tickets in the dataset')
+    parser.add_option('--ops', type='int', default=1000, help='operations per case')
+    parser.add_option('--dsn', default='dbname=pyorm_test')
+    parser.add_option('--output', help='write the JSON report to this file')
+    parser.add_option('--compare', action='store_true', help='compare two JSON reports')
+    parser.add_option('--threshold', type='float', default=0.1)
+    options, args = parser.parse_args()
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs two reports')
+        old, new = [json.load(open(fn)) for fn in args]
+        regressions = compare(old, new, options.threshold)
+        for name, case, metric, before, after in regressions:
+            print '%s %s %s: %.3f -> %.3f' % (name, case, metric, before, after)
+        sys.exit(regressions and 1 or 0)
+    options.datasource = options.datasource or ['memory']
+    report = run(options)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data)
+        f.close()
+    else:
+        print data
+
+if __name__ == '__main__':
+    main()
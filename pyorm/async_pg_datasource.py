@@ -0,0 +1,42 @@
+"""Non-blocking Postgres access for event loop based servers.
+
+pyorm runs on Python 2, which has no asyncio and no async/await syntax, so
+there is no coroutine mirror of pg_datasource here. Instead psycopg2 is made
+cooperative: with a wait callback installed, every statement of a regular
+pg_datasource.DataSet yields to the event loop (gevent, eventlet) while it
+waits for the server. Models, Query iteration, $(schema). rewriting and
+transactions work unchanged.
+
+    from gevent.socket import wait_read, wait_write
+    async_pg_datasource.install(wait_read, wait_write)
+    ds = pg_datasource.DataSet(psycopg2.connect(dsn), schema='tenant1')
+
+psycopg2 doesn't support COPY while a wait callback is installed, so
+save_many and deferred flushes insert with multi-row inserts instead.
+"""
+
+import psycopg2
+from psycopg2 import extensions
+
+def make_wait_callback(wait_read, wait_write):
+    """psycopg2 wait callback polling the connection and waiting for its socket
+    with the event loop functions wait_read(fd) and wait_write(fd)"""
+    def wait(con):
+        while True:
+            state = con.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(con.fileno())
+            elif state == extensions.POLL_WRITE:
+                wait_write(con.fileno())
+            else:
+                raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+    return wait
+
+def install(wait_read, wait_write):
+    """Make all psycopg2 connections of the process cooperative"""
+    extensions.set_wait_callback(make_wait_callback(wait_read, wait_write))
+
+def uninstall():
+    extensions.set_wait_callback(None)
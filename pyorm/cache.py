@@ -0,0 +1,206 @@
+"""Opt-in read-through entity cache.
+
+    cache = EntityCache(max_entries=10000, ttl=60)
+    ds = CachedDataSet(pg_datasource.DataSet(con, schema='tenant1'), cache)
+    user = User.get(ds, 'John')
+
+Entries are keyed by (schema, table name, primary key), so DataSets of
+different tenants can share one cache. Don't share a cache between
+DataSets of different databases. Rows are cached as data dicts and every
+hit builds a new model instance.
+"""
+
+import sys
+import time
+from model import ORMError
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
+
+class EntityCache(object):
+    """LRU of model data bounded by entry count and, optionally, by an
+    estimate of the memory used. Entries expire after ttl seconds if ttl
+    is given."""
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None, clock=time.time):
+        if OrderedDict is None:
+            raise ORMError("EntityCache requires python 2.7")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (data, size, expires, generation)
+        self.entries = OrderedDict()
+        # (schema, table name) -> generation, bumped when the table changes in bulk
+        self.generations = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    def sizeof(self, data):
+        size = sys.getsizeof(data)
+        for name, value in data.iteritems():
+            size += sys.getsizeof(name) + sys.getsizeof(value)
+        return size
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, size, expires, generation = entry
+        if (expires is not None and expires < self.clock()) or generation != self.generations.get(key[:2], 0):
+            self.bytes -= size
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return data
+    def put(self, key, data):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(data)
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        self.entries[key] = (data, size, expires, self.generations.get(key[:2], 0))
+        self.bytes += size
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            old_key, old = self.entries.popitem(last=False)
+            self.bytes -= old[1]
+            self.evictions += 1
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            self.invalidations += 1
+    def invalidate_table(self, schema, table_name):
+        """Drop all entries of the table lazily"""
+        key = (schema, table_name)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        self.invalidations += 1
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                invalidations=self.invalidations, size=len(self.entries), bytes=self.bytes)
+
+class CachedDataSet(object):
+    """Wraps a DataSet of any datasource. get reads through the cache; save,
+    delete, Query.update and Query.delete made through the wrapper invalidate
+    it. Other attributes are delegated to the wrapped DataSet.
+
+    Rows changed since the last commit are invalidated again after flush,
+    as deferred writes reach the database only then, and on rollback, as a
+    get may have cached their uncommitted data."""
+    def __init__(self, ds, cache):
+        self.ds = ds
+        self.cache = cache
+        # cache keys and (schema, table name) changed since the last commit
+        self.touched = set()
+        self.touched_tables = set()
+    def __getattr__(self, name):
+        return getattr(self.ds, name)
+    def cache_key(self, model_cls, key):
+        if isinstance(key, tuple) and len(key) == 1 and ',' not in model_cls._key:
+            key = key[0]
+        return (getattr(self.ds, 'schema', ''), model_cls._table_name, key)
+    def model_keys(self, model):
+        """Cache keys of the current and original primary key of model"""
+        keys = []
+        getters = [model.data.get]
+        if model.changed:
+            getters.append(model.original)
+        for get in getters:
+            if ',' in model._key:
+                key = tuple([get(k) for k in model._key.split(',')])
+            else:
+                key = get(model._key)
+            keys.append(self.cache_key(model, key))
+        return keys
+    def get(self, model_cls, key):
+        if getattr(self.ds, 'pipe', None) is not None:
+            return self.ds.get(model_cls, key)
+        cache_key = self.cache_key(model_cls, key)
+        data = self.cache.get(cache_key)
+        if data is not None:
+            res = model_cls(self, **data)
+            res.saved = True
+            return res
+        res = self.ds.get(model_cls, key)
+        if res is not None:
+            res.session = self
+            self.cache.put(cache_key, dict(res.data))
+        return res
+    def get_many(self, model_cls, keys):
+        keys = list(keys)
+        res = []
+        missing = []
+        for key in keys:
+            data = self.cache.get(self.cache_key(model_cls, key))
+            if data is None:
+                missing.append(key)
+                res.append(None)
+            else:
+                model = model_cls(self, **data)
+                model.saved = True
+                res.append(model)
+        if missing:
+            loaded = dict(zip(missing, self.ds.get_many(model_cls, missing)))
+            for i, key in enumerate(keys):
+                if res[i] is None and loaded[key] is not None:
+                    res[i] = loaded[key]
+                    res[i].session = self
+                    self.cache.put(self.cache_key(model_cls, key), dict(res[i].data))
+        return res
+    def invalidate(self, keys):
+        for key in keys:
+            self.cache.invalidate(key)
+            self.touched.add(key)
+    def invalidate_touched(self):
+        for key in self.touched:
+            self.cache.invalidate(key)
+        for schema, table_name in self.touched_tables:
+            self.cache.invalidate_table(schema, table_name)
+    def save(self, model):
+        keys = self.model_keys(model)
+        self.ds.save(model)
+        self.invalidate(keys)
+    def save_many(self, models, *args, **kwargs):
+        keys = []
+        for model in models:
+            keys.extend(self.model_keys(model))
+        self.ds.save_many(models, *args, **kwargs)
+        self.invalidate(keys)
+    def delete(self, model):
+        self.invalidate(self.model_keys(model))
+        self.ds.delete(model)
+    def table_changed(self, model_cls):
+        table = (getattr(self.ds, 'schema', ''), model_cls._table_name)
+        self.cache.invalidate_table(*table)
+        self.touched_tables.add(table)
+        self.ds.table_changed(model_cls)
+    def defer(self, enabled=True):
+        self.ds.defer(enabled)
+        if not enabled:
+            self.invalidate_touched()
+    def flush(self):
+        self.ds.flush()
+        self.invalidate_touched()
+    def commit(self):
+        self.ds.commit()
+        self.invalidate_touched()
+        self.touched = set()
+        self.touched_tables = set()
+    def rollback(self):
+        self.ds.rollback()
+        self.invalidate_touched()
+        self.touched = set()
+        self.touched_tables = set()
+    def query(self, model_class, props):
+        return self.ds.query_class(model_class, self, props)
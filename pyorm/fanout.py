@@ -0,0 +1,330 @@
+"""One Query run in many tenant schemas of a Postgres database.
+
+    fanout = FanOut(lambda: psycopg2.connect(dsn), ['tenant1', 'tenant2', ...], workers=8)
+    for tenant, ticket in Ticket.query(fanout).filter('state', 'Open').order('-date_opened'):
+        print tenant, ticket.subject
+    total = Ticket.query(fanout).filter('state', 'Open').count()
+
+Up to union_limit schemas are read with one union all statement on one
+connection. More schemas are split between `workers` threads, each holding
+one connection from connect, and the results are merged in query order.
+Iteration streams: rows are read through server-side cursors into a queue
+of at most buffer_size models per tenant, from which the merge pulls. An
+ordered query over more schemas than workers can't wait for a tenant which
+no worker has started yet, so its queues are unbounded.
+Returned models belong to a DataSet of their tenant on a connection which
+is released afterwards, so save changes through a DataSet of your own.
+"""
+
+import threading
+import heapq
+from Queue import Queue, Empty, Full
+from itertools import count as counter
+from pg_datasource import DataSet
+
+DONE = object()
+
+class FeedError(object):
+    __slots__ = ('error',)
+    def __init__(self, error):
+        self.error = error
+
+class Feed(object):
+    """Queue of the models of one tenant, filled by a worker thread while the
+    merge reads it. Writers give up once stop is set by the reader."""
+    def __init__(self, tenant, size, stop):
+        self.tenant = tenant
+        self.queue = Queue(size)
+        self.stop = stop
+    def put(self, item):
+        """False if the reader went away"""
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, True, 0.1)
+                return True
+            except Full:
+                pass
+        return False
+    def fail(self, error):
+        self.put(FeedError(error))
+    def run(self, models):
+        """Put the models of models() and the end mark, or the error"""
+        try:
+            for model in models():
+                if not self.put(model):
+                    return
+        except Exception, e:
+            self.fail(e)
+            return
+        self.put(DONE)
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is DONE:
+                return
+            if isinstance(item, FeedError):
+                raise item.error
+            yield item
+
+def merge_feeds(feeds, stop, order_props):
+    """merge of feeds, their writers are stopped when the result is closed"""
+    try:
+        for item in merge([(feed.tenant, feed) for feed in feeds], order_props):
+            yield item
+    finally:
+        stop.set()
+
+class MergeKey(object):
+    """Sort key for orders mixing ascending and descending values"""
+    __slots__ = ('values', 'reverse')
+    def __init__(self, values, reverse):
+        self.values = values
+        self.reverse = reverse
+    def __lt__(self, other):
+        for a, b, reverse in zip(self.values, other.values, self.reverse):
+            if a != b:
+                if reverse:
+                    return b < a
+                return a < b
+        return False
+
+def merge(streams, order_props):
+    """k-way merge of (tenant, models) streams sorted by order_props into
+    one stream of (tenant, model). Unordered streams are read one after
+    another."""
+    if not order_props:
+        for tenant, models in streams:
+            for model in models:
+                yield tenant, model
+        return
+    props = [p for p, reverse in order_props]
+    reverse = [reverse for p, reverse in order_props]
+    heap = []
+    seq = counter()
+    def push(tenant, it):
+        for model in it:
+            heapq.heappush(heap, (MergeKey([model[p] for p in props], reverse), seq.next(), tenant, model, it))
+            break
+    for tenant, models in streams:
+        push(tenant, iter(models))
+    while heap:
+        key, n, tenant, model, it = heapq.heappop(heap)
+        yield tenant, model
+        push(tenant, it)
+
+class FanOutQuery(object):
+    """Records filter, order and group_by calls and replays them on a Query
+    of each tenant"""
+    def __init__(self, model_class, fanout, props):
+        self.model = model_class
+        self.fanout = fanout
+        self.props = props
+        self.calls = []
+        self._order_props = []
+        self._group_by = []
+    def filter(self, *args, **kwargs):
+        self.calls.append(('filter', args, kwargs))
+        return self
+    def raw_filter(self, sql, params={}):
+        self.calls.append(('raw_filter', (sql, params), {}))
+        return self
+    def order(self, fields):
+        self.calls.append(('order', (fields,), {}))
+        self._order_props = []
+        for prop_name in [f.strip() for f in fields.split(',')]:
+            if prop_name[0] == '-':
+                self._order_props.append((prop_name[1:], True))
+            else:
+                self._order_props.append((prop_name, False))
+        return self
+    def group_by(self, *props):
+        self.calls.append(('group_by', props, {}))
+        self._group_by = list(props)
+        return self
+    def tenant_query(self, ds):
+        props = self.props
+        if props:
+            # the merge needs the order props
+            names = props.split(',')
+            names.extend([p for p, reverse in self._order_props if p not in names])
+            props = ','.join(names)
+        query = ds.query(self.model, props)
+        for name, args, kwargs in self.calls:
+            getattr(query, name)(*args, **kwargs)
+        return query
+    def __iter__(self):
+        """(tenant, model) pairs in query order"""
+        if self.fanout.use_union():
+            return self.fanout.union_iter(self)
+        return self.fanout.stream(self)
+    def fetch(self, limit):
+        """First limit (tenant, model) pairs, limit rows read per tenant"""
+        results = self.fanout.map(self, lambda query: query.fetch(limit))
+        res = []
+        for item in merge(results, self._order_props):
+            if len(res) == limit:
+                break
+            res.append(item)
+        return res
+    def counts(self):
+        """{tenant: count}"""
+        return dict(self.fanout.map(self, lambda query: query.count()))
+    def count(self):
+        if self.fanout.use_union():
+            return self.fanout.union_count(self)
+        return sum(self.counts().itervalues())
+    def aggregate(self, **aggregates):
+        """Query.aggregate of the tenants combined"""
+        results = self.fanout.map(self, lambda query: query.aggregate(**aggregates))
+        names = sorted(aggregates)
+        if not self._group_by:
+            res = dict([(name, aggregates[name].start) for name in names])
+            for tenant, row in results:
+                for name in names:
+                    res[name] = aggregates[name].combine(res[name], row[name])
+            return res
+        groups = {}
+        for tenant, rows in results:
+            for row in rows:
+                key = tuple([row[p] for p in self._group_by])
+                if key not in groups:
+                    groups[key] = row
+                else:
+                    acc = groups[key]
+                    for name in names:
+                        acc[name] = aggregates[name].combine(acc[name], row[name])
+        return [groups[key] for key in sorted(groups)]
+
+class FanOut(object):
+    """Runs queries in every schema of schemas. connect() returns a new
+    connection, release(con) disposes of it (closes it by default).
+    buffer_size is the number of rows fetched at once and queued per tenant
+    while iterating."""
+    def __init__(self, connect, schemas, workers=8, union_limit=8, release=None, dataset_class=DataSet,
+                 buffer_size=1000):
+        self.connect = connect
+        self.release = release or (lambda con: con.close())
+        self.schemas = list(schemas)
+        self.workers = workers
+        self.union_limit = union_limit
+        self.dataset_class = dataset_class
+        self.buffer_size = buffer_size
+    def query(self, model_class, props):
+        return FanOutQuery(model_class, self, props)
+    def use_union(self):
+        return len(self.schemas) <= self.union_limit
+    def map(self, query, fn):
+        """[(tenant, fn(tenant Query))] in schemas order, computed by the workers"""
+        jobs = Queue()
+        for i, schema in enumerate(self.schemas):
+            jobs.put((i, schema))
+        results = [None] * len(self.schemas)
+        errors = []
+        def work():
+            con = None
+            try:
+                con = self.connect()
+                while not errors:
+                    try:
+                        i, schema = jobs.get_nowait()
+                    except Empty:
+                        break
+                    ds = self.dataset_class(con, schema)
+                    results[i] = (schema, fn(query.tenant_query(ds)))
+                    con.rollback()
+            except Exception, e:
+                errors.append(e)
+            if con is not None:
+                self.release(con)
+        threads = [threading.Thread(target=work) for i in range(min(self.workers, len(self.schemas)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+    def stream(self, query):
+        """(tenant, model) pairs in query order, streamed by the workers"""
+        size = self.buffer_size
+        if query._order_props and len(self.schemas) > self.workers:
+            size = 0
+        stop = threading.Event()
+        feeds = [Feed(schema, size, stop) for schema in self.schemas]
+        jobs = Queue()
+        for feed in feeds:
+            jobs.put(feed)
+        def work():
+            con = None
+            try:
+                while not stop.is_set():
+                    try:
+                        feed = jobs.get_nowait()
+                    except Empty:
+                        break
+                    if con is None:
+                        try:
+                            con = self.connect()
+                        except Exception, e:
+                            feed.fail(e)
+                            continue
+                    ds = self.dataset_class(con, feed.tenant)
+                    feed.run(lambda: query.tenant_query(ds).stream(self.buffer_size))
+                    try:
+                        con.rollback()
+                    except Exception:
+                        self.release(con)
+                        con = None
+            finally:
+                if con is not None:
+                    self.release(con)
+        for i in range(min(self.workers, len(feeds))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+        return merge_feeds(feeds, stop, query._order_props)
+    def union_sql(self, query, head=None):
+        """union all of the query in every schema with the schema as first
+        column, and its parameters"""
+        parts = []
+        params = {}
+        for i, schema in enumerate(self.schemas):
+            q = query.tenant_query(self.dataset_class(None, schema))
+            params.update(q.params)
+            params['pyorm_tenant%d' % i] = schema
+            sql = q.get_sql(head=head or 'select ' + q.model._meta.field_list(q.props), ignore_order=True)
+            sql = sql.replace('select ', 'select %%(pyorm_tenant%d)s::text as pyorm_tenant, ' % i, 1)
+            parts.append('(%s)' % q.session.fix_sql(sql))
+        sql = '\nunion all\n'.join(parts)
+        if q._order:
+            sql += '\norder by %s' % ', '.join(q._order)
+        return sql, params, q
+    def union_iter(self, query):
+        """(tenant, model) pairs of the union all statement, read from a
+        server-side cursor buffer_size rows at a time"""
+        sql, params, q = self.union_sql(query)
+        con = self.connect()
+        try:
+            ds = DataSet(con)
+            cur = ds.execute(sql, params, cursor_name=ds.new_cursor_name())
+            sessions = dict([(schema, self.dataset_class(con, schema)) for schema in self.schemas])
+            load = q.model._meta.loader(q.props)
+            while True:
+                rows = cur.fetchmany(self.buffer_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0], load(sessions[row[0]], row[1:])
+            cur.close()
+            con.rollback()
+        finally:
+            self.release(con)
+    def union_count(self, query):
+        sql, params, q = self.union_sql(query, head='select count(1) as cnt')
+        con = self.connect()
+        try:
+            res = DataSet(con).execute('select sum(cnt) from (%s) q' % sql, params).fetchone()[0]
+            con.rollback()
+        finally:
+            self.release(con)
+        return int(res or 0)
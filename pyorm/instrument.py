@@ -0,0 +1,150 @@
+"""Instrumentation of datasource operations.
+
+    stats = QueryStats(slow_threshold=0.1)
+    ds.observers.append(stats)
+    ...
+    for fingerprint, entry in stats.top(10):
+        print entry['count'], entry['total'], fingerprint
+
+Observers get before(event) and after(event) calls around every statement
+pg_datasource sends and around memory_datasource operations. A DataSet
+without observers only pays for one empty list check per statement.
+"""
+
+import re
+import time
+import logging
+from bisect import bisect_right
+
+log = logging.getLogger('pyorm')
+
+fingerprint_rules = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\?(?:\s*,\s*\?)+\)'), '(?)'),
+    (re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+'), '(?), ...'),
+    (re.compile(r'\s+'), ' '),
+]
+fingerprints = {}
+
+def fingerprint(sql):
+    """sql with literals and parameters replaced by ?, so that statements
+    differing only by values get the same fingerprint"""
+    res = fingerprints.get(sql)
+    if res is None:
+        res = sql
+        for pattern, repl in fingerprint_rules:
+            res = pattern.sub(repl, res)
+        res = res.strip()
+        if len(fingerprints) > 10000:
+            fingerprints.clear()
+        fingerprints[sql] = res
+    return res
+
+class Event(object):
+    """One statement or operation. model and operation are the model class
+    and the DataSet or Query method which issued it, when known. rows is
+    the row count reported by the datasource, -1 if unknown."""
+    __slots__ = ('ds', 'model', 'operation', 'sql', 'params', 'start', 'elapsed', 'rows')
+    def __init__(self, ds, op, sql, params):
+        self.ds = ds
+        self.model, self.operation = op or (None, None)
+        self.sql = sql
+        self.params = params
+        self.start = None
+        self.elapsed = None
+        self.rows = -1
+    @property
+    def fingerprint(self):
+        return fingerprint(self.sql)
+
+def observe(ds, op, sql, params, fn, args, rows=None):
+    """Call fn(*args) between the before and after calls of ds.observers.
+    rows(result) gives the row count of the event."""
+    event = Event(ds, op, sql, params)
+    observers = list(ds.observers)
+    for observer in observers:
+        observer.before(event)
+    event.start = time.time()
+    try:
+        res = fn(*args)
+        if rows is not None:
+            event.rows = rows(res)
+    finally:
+        event.elapsed = time.time() - event.start
+        for observer in observers:
+            observer.after(event)
+    return res
+
+class Observer(object):
+    def before(self, event):
+        pass
+    def after(self, event):
+        pass
+
+class QueryStats(Observer):
+    """Count, total and max time, rows and a latency histogram per fingerprint.
+    histogram[i] counts the statements faster than bounds[i] seconds, the
+    last bucket the slower ones. Statements slower than slow_threshold
+    seconds are logged as warnings."""
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+    def __init__(self, slow_threshold=None, logger=log):
+        self.slow_threshold = slow_threshold
+        self.logger = logger
+        self.stats = {}
+        self.slow = 0
+    def after(self, event):
+        fp = event.fingerprint
+        entry = self.stats.get(fp)
+        if entry is None:
+            entry = self.stats[fp] = dict(count=0, total=0.0, max=0.0, rows=0,
+                    histogram=[0] * (len(self.bounds) + 1))
+        entry['count'] += 1
+        entry['total'] += event.elapsed
+        entry['max'] = max(entry['max'], event.elapsed)
+        if event.rows > 0:
+            entry['rows'] += event.rows
+        entry['histogram'][bisect_right(self.bounds, event.elapsed)] += 1
+        if self.slow_threshold is not None and event.elapsed >= self.slow_threshold:
+            self.slow += 1
+            self.logger.warning("slow query (%.3fs, %s.%s): %s", event.elapsed,
+                    getattr(event.model, '__name__', None), event.operation, event.sql)
+    def top(self, n=10, by='total'):
+        """[(fingerprint, entry)] of the n fingerprints with the biggest entry[by]"""
+        return sorted(self.stats.iteritems(), key=lambda item: item[1][by], reverse=True)[:n]
+    def reset(self):
+        self.stats = {}
+        self.slow = 0
+
+class NPlusOneDetector(Observer):
+    """Flags model classes read with threshold or more get() calls inside one
+    scope, a web request or a job, where one get_many or query would do.
+
+        with detector:
+            handle_request()
+        for model_cls, count in detector.warnings: ...
+    """
+    def __init__(self, threshold=10, logger=log):
+        self.threshold = threshold
+        self.logger = logger
+        self.active = False
+        self.counts = {}
+        self.warnings = []
+    def __enter__(self):
+        self.active = True
+        self.counts = {}
+        self.warnings = []
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.active = False
+        for i, (model_cls, count) in enumerate(self.warnings):
+            self.warnings[i] = (model_cls, self.counts[model_cls])
+    def after(self, event):
+        if not self.active or event.operation != 'get':
+            return
+        count = self.counts[event.model] = self.counts.get(event.model, 0) + 1
+        if count == self.threshold:
+            self.warnings.append((event.model, count))
+            self.logger.warning("N+1 queries: %d or more get() of %s in one scope", count,
+                    getattr(event.model, '__name__', event.model))
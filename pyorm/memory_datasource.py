@@ -1,6 +1,25 @@
 
-from os.path import isfile
+import os
+from os.path import isfile, getsize
+from bisect import bisect_left, bisect_right
+from functools import partial
+from itertools import islice, imap, groupby
+import heapq
+import operator
+from datetime import datetime
 import cPickle as pc
+from instrument import observe
+from model import ORMError, FilterError, Pipeline, UnitOfWork, group_by_class, as_expression, \
+        encode_token, decode_token
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from collections import namedtuple
+except ImportError:
+    namedtuple = None
+from memory_snapshot import is_snapshot, encode_table, encode_columns, write_snapshot, SnapshotReader
 
 def eq(x, y): return x == y
 def neq(x, y): return x != y
@@ -34,8 +53,152 @@ def make_cond_2(ind, op, val):
         return fn(rec[ind], val)
     return cmp
 
-def desc(a, b):
-    return cmp(b,a)
+class OrderKey(object):
+    """Sort key for orders mixing ascending and descending columns"""
+    __slots__ = ('rec', 'positions')
+    def __init__(self, rec, positions):
+        self.rec = rec
+        self.positions = positions
+    def __lt__(self, other):
+        for ind, reverse in self.positions:
+            a, b = self.rec[ind], other.rec[ind]
+            if a != b:
+                if reverse:
+                    return b < a
+                return a < b
+        return False
+
+class HashIndex(object):
+    """value -> set of keys. Serves '=' and 'in' conditions."""
+    kind = 'hash'
+    ops = ('=', 'in')
+    def __init__(self, prop, ind):
+        self.prop = prop
+        self.ind = ind
+        self.buckets = {}
+    def build(self, items):
+        for key, rec in items:
+            self.insert(key, rec)
+    def insert(self, key, rec):
+        self.buckets.setdefault(rec[self.ind], set()).add(key)
+    def remove(self, key, rec):
+        val = rec[self.ind]
+        bucket = self.buckets.get(val)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[val]
+    def remove_many(self, items):
+        for key, rec in items:
+            self.remove(key, rec)
+    def estimate(self, op, val):
+        if op == '=':
+            return len(self.buckets.get(val, ()))
+        return sum([len(self.buckets.get(v, ())) for v in set(val)])
+    def lookup(self, op, val):
+        if op == '=':
+            return self.buckets.get(val, ())
+        res = set()
+        for v in val:
+            res.update(self.buckets.get(v, ()))
+        return res
+
+def sort_value(value):
+    """Sort key of SortedIndex values: None first, so that it never has to be
+    compared with a value (datetime refuses to compare with None)"""
+    return (value is not None, value)
+
+# below every non-null sort_value, range conditions start there
+NOT_NULL = (True,)
+
+class SortedIndex(object):
+    """Parallel lists of sort_value(value) and keys sorted by (value, key),
+    so that an entry is found by bisection even among many equal values.
+    Serves '=', 'in', range conditions and ordering."""
+    kind = 'sorted'
+    ops = ('=', 'in', '<', '<=', '>', '>=')
+    def __init__(self, prop, ind):
+        self.prop = prop
+        self.ind = ind
+        self.values = []
+        self.keys = []
+        self.by_key = True
+    def __setstate__(self, state):
+        # indexes pickled before runs of equal values were ordered by key
+        self.__dict__.update(state)
+        if not state.get('by_key'):
+            self.fill(zip([sort_value(v) for v in self.values], self.keys))
+    def build(self, items):
+        """Fill the index with (key, record) items in one sort"""
+        ind = self.ind
+        self.fill([(sort_value(rec[ind]), key) for key, rec in items])
+    def fill(self, pairs):
+        pairs.sort()
+        self.values = [value for value, key in pairs]
+        self.keys = [key for value, key in pairs]
+        self.by_key = True
+    def position(self, key, val, find):
+        """find (bisect_left or bisect_right) position of (val, key)"""
+        val = sort_value(val)
+        lo = bisect_left(self.values, val)
+        hi = bisect_right(self.values, val, lo)
+        return find(self.keys, key, lo, hi), hi
+    def insert(self, key, rec):
+        val = rec[self.ind]
+        i, hi = self.position(key, val, bisect_right)
+        self.values.insert(i, sort_value(val))
+        self.keys.insert(i, key)
+    def remove(self, key, rec):
+        val = rec[self.ind]
+        i, hi = self.position(key, val, bisect_left)
+        if i < hi and self.keys[i] == key:
+            del self.values[i]
+            del self.keys[i]
+    def remove_many(self, items):
+        """Remove (key, record) items, in one pass over the index if they are many"""
+        if len(items) * 32 < len(self.keys):
+            for key, rec in items:
+                self.remove(key, rec)
+            return
+        gone = set([key for key, rec in items])
+        pairs = [(value, key) for value, key in zip(self.values, self.keys) if key not in gone]
+        self.values = [value for value, key in pairs]
+        self.keys = [key for value, key in pairs]
+    def bounds(self, op, val):
+        values = self.values
+        val = sort_value(val)
+        if op == '=':
+            return bisect_left(values, val), bisect_right(values, val)
+        elif op == '<':
+            return bisect_left(values, NOT_NULL), bisect_left(values, val)
+        elif op == '<=':
+            return bisect_left(values, NOT_NULL), bisect_right(values, val)
+        elif op == '>':
+            return bisect_right(values, val), len(values)
+        else:
+            return bisect_left(values, val), len(values)
+    def estimate(self, op, val):
+        if op == 'in':
+            return sum([self.estimate('=', v) for v in set(val)])
+        lo, hi = self.bounds(op, val)
+        return hi - lo
+    def lookup(self, op, val):
+        if op == 'in':
+            res = set()
+            for v in val:
+                res.update(self.lookup('=', v))
+            return res
+        lo, hi = self.bounds(op, val)
+        return self.keys[lo:hi]
+    def ordered(self, reverse=False):
+        if reverse:
+            return reversed(self.keys)
+        return iter(self.keys)
+
+index_types = {
+    'hash': HashIndex,
+    'sorted': SortedIndex,
+}
 
 class Query(object):
     def __init__(self, model_cls, ds, props):
@@ -43,13 +206,15 @@ class Query(object):
         self.ds = ds
         self.table = ds.get_table(model_cls)
         self.conditions = []
-        self._order = ''
+        self.filters = []
+        self._order_props = []
+        self._group_by = []
         if props:
             self.props = props.split(',')
         elif model_cls._default_props:
             self.props = model_cls._default_props
         else:
-            self.props = [p for p in model_cls._properties.keys() if not model_cls._properties[p].virtual]
+            self.props = model_cls._meta.props
     def filter(self, *args, **kwargs):
         if args:
             assert len(args)==2, "filter method require exactly 2 positional parameters"
@@ -68,7 +233,7 @@ class Query(object):
             prop_name, op = arr
         else:
             raise FilterError("Wrong filter prop: %s" % repr(prop))
-        ind = self.props.index(prop)
+        ind = self.table.props.index(prop_name)
         if value is None:
             if op == '=':
                 fn = is_null
@@ -79,123 +244,1113 @@ class Query(object):
             self.conditions.append(make_cond_1(ind, fn))
         else:
             self.conditions.append(make_cond_2(ind, op, value))
+        self.filters.append((prop_name, op, value))
     def check(self, rec):
         for cond in self.conditions:
             if not cond(rec):
                 return False
         return True
+    def iter_recs(self):
+        """Matching records as a generator. Iterates over a snapshot of the
+        candidate records, so the table can be modified while the query runs."""
+        table = self.table
+        if table.columnar:
+            record = table.record
+            return iter([record(pos) for pos in table.select(self.filters)])
+        data = table.data
+        keys = table.lookup(self.filters)
+        if keys is None:
+            recs = data.values()
+        else:
+            recs = [data[k] for k in keys]
+        check = self.check
+        return (r for r in recs if check(r))
     def get_rec_list(self):
-        return [r for r in self.table.data.itervalues() if self.check(r)]
+        return list(self.iter_recs())
+    def get_items(self):
+        """[(key, record)] of the matching records"""
+        table = self.table
+        if table.columnar:
+            row_keys, record = table.row_keys, table.record
+            return [(row_keys[pos], record(pos)) for pos in table.select(self.filters)]
+        data = table.data
+        keys = table.lookup(self.filters)
+        if keys is None:
+            items = data.iteritems()
+        else:
+            items = [(k, data[k]) for k in keys]
+        check = self.check
+        return [(k, r) for k, r in items if check(r)]
+    def iter_index_ordered(self):
+        """Records in query order taken from a sorted index, or None
+        if the order can't be served by an index or a filter index is cheaper"""
+        if len(self._order_props) != 1:
+            return None
+        prop_name, reverse = self._order_props[0]
+        index = self.table.indexes.get(prop_name)
+        if not isinstance(index, SortedIndex):
+            return None
+        if self.table.lookup(self.filters) is not None:
+            return None
+        data = self.table.data
+        check = self.check
+        return (r for r in [data[k] for k in index.ordered(reverse)] if check(r))
+    def sort_key(self):
+        """Key function over records and reverse flag for the query order"""
+        try:
+            positions = [(self.table.props.index(p), reverse) for p, reverse in self._order_props]
+        except ValueError:
+            raise ORMError("Wrong order props for %s" % self.table.name)
+        directions = set([reverse for ind, reverse in positions])
+        if len(directions) == 1:
+            return operator.itemgetter(*[ind for ind, reverse in positions]), directions.pop()
+        def key(rec):
+            return OrderKey(rec, positions)
+        return key, False
+    def iter_sorted_recs(self, limit=None, offset=0):
+        """Matching records in query order, sliced by limit and offset.
+        With a limit only limit+offset records are kept in a bounded heap."""
+        if self._order_props:
+            recs = self.iter_index_ordered()
+            if recs is None:
+                key, reverse = self.sort_key()
+                if limit is None:
+                    recs = sorted(self.iter_recs(), key=key, reverse=reverse)
+                elif reverse:
+                    recs = heapq.nlargest(limit + offset, self.iter_recs(), key=key)
+                else:
+                    recs = heapq.nsmallest(limit + offset, self.iter_recs(), key=key)
+        else:
+            recs = self.iter_recs()
+        if limit is not None:
+            return islice(recs, offset, offset + limit)
+        elif offset:
+            return islice(recs, offset, None)
+        return iter(recs)
+    def page(self, limit, after=None):
+        """Models of the page following the row of token after (the first page
+        if None) and the token of the page last row, None on the last page.
+        Rows are ordered by the order() props and then by the primary key.
+        With a sorted index on the first order prop the scan starts at the
+        token position found by bisect, otherwise the page is taken from
+        the matching records with a bounded heap."""
+        props = self.table.props
+        keyset = list(self._order_props)
+        ordered = [p for p, reverse in keyset]
+        keyset.extend([(p, False) for p in self.model_cls._meta.key if p not in ordered])
+        try:
+            positions = [(props.index(p), reverse) for p, reverse in keyset]
+        except ValueError:
+            raise ORMError("Wrong order props for %s" % self.table.name)
+        def key(rec):
+            return OrderKey(rec, positions)
+        bound = None
+        if after is not None:
+            values = decode_token(after)
+            if len(values) != len(keyset):
+                raise ORMError("Wrong page token: %r" % after)
+            bound_rec = [None] * len(props)
+            for (ind, reverse), value in zip(positions, values):
+                bound_rec[ind] = value
+            bound = key(bound_rec)
+        first, reverse = positions[0]
+        index = self.table.indexes.get(keyset[0][0])
+        if isinstance(index, SortedIndex) and self.table.lookup(self.filters) is None:
+            data, check, keys = self.table.data, self.check, index.keys
+            if bound is None:
+                start = reverse and len(keys) - 1 or 0
+            elif reverse:
+                start = bisect_right(index.values, sort_value(bound.rec[first])) - 1
+            else:
+                start = bisect_left(index.values, sort_value(bound.rec[first]))
+            if reverse:
+                order = xrange(start, -1, -1)
+            else:
+                order = xrange(start, len(keys))
+            recs = []
+            # index order only covers the first prop, sort each run of equal values
+            for value, run in groupby((data[keys[i]] for i in order), operator.itemgetter(first)):
+                recs.extend(sorted([r for r in run if check(r) and (bound is None or bound < key(r))], key=key))
+                if len(recs) > limit:
+                    break
+            recs = recs[:limit + 1]
+        else:
+            recs = self.iter_recs()
+            if bound is not None:
+                recs = (r for r in recs if bound < key(r))
+            recs = heapq.nsmallest(limit + 1, recs, key=key)
+        models = map(self.make_loader(), recs[:limit])
+        token = None
+        if len(recs) > limit:
+            token = encode_token([recs[limit - 1][ind] for ind, reverse in positions])
+        return models, token
+    def make_loader(self):
+        """Function building a saved model instance from a table record"""
+        props = [p for p in self.table.props if p in self.props]
+        return partial(self.model_cls._meta.loader(props, self.table.props), self.ds)
     def __iter__(self):
-        props = [(p,i) for i, p in enumerate(self.table.props) if p in self.props]
-        def map_fnc(rec):
-            res = self.model_cls(self.ds, **dict((p, rec[i]) for p,i in props))
-            res.saved = True
-            return res
-        l = map(map_fnc, self.get_rec_list())
-        if self._order:
-            l.sort(cmp = self._order)
-        return l.__iter__()
+        return imap(self.make_loader(), self.iter_sorted_recs())
+    def iter_rows(self, props):
+        try:
+            positions = [self.table.props.index(p) for p in props]
+        except ValueError:
+            raise ORMError("Wrong props %s for %s" % (repr(props), self.table.name))
+        if positions == range(len(self.table.props)):
+            return self.iter_sorted_recs()
+        if len(positions) == 1:
+            ind = positions[0]
+            return ((rec[ind],) for rec in self.iter_sorted_recs())
+        return imap(operator.itemgetter(*positions), self.iter_sorted_recs())
+    def tuples(self, named=False):
+        """Iterate over rows as tuples in Query.props order, or as namedtuples.
+        No models are built: a row costs at most one tuple taken from the record."""
+        if named:
+            row_cls = namedtuple('Row', self.props)
+            return imap(row_cls._make, self.iter_rows(self.props))
+        return self.iter_rows(self.props)
+    def values(self, *props):
+        """Iterate over rows as dicts of props (Query.props by default)"""
+        props = list(props) or self.props
+        return (dict(zip(props, row)) for row in self.iter_rows(props))
+    def scalar_list(self, prop):
+        """List of values of one property"""
+        return [row[0] for row in self.iter_rows([prop])]
+    def stream(self, batch_size=1000):
+        """Same as iteration, which is already lazy. Mirrors pg_datasource.Query.stream"""
+        return self.__iter__()
     def order(self, props):
         props = [p.strip() for p in props.split(',')]
-        sort_list = []
+        self._order_props = []
         for p in props:
             if p.startswith('-'):
-                sort_list.append((p[1:], desc))
+                self._order_props.append((p[1:], True))
             else:
-                sort_list.append((p, cmp))
-        def cmp_fnc(a,b):
-            for p, fn in sort_list:
-                r = fn(a[p],b[p])
-                if r:
-                    return r
-            return r
-        self._order = cmp_fnc
+                self._order_props.append((p, False))
         return self
+    def observed(self, operation, fn, rows=None):
+        """fn() reported to the DataSet observers as operation"""
+        if not self.ds.observers:
+            return fn()
+        sql = '%s %s' % (operation, self.table.name)
+        if self.filters:
+            sql += ' where ' + ' and '.join(['%s %s ?' % (p, op) for p, op, value in self.filters])
+        return observe(self.ds, (self.model_cls, operation), sql, [value for p, op, value in self.filters],
+                fn, (), rows)
+    def count_recs(self):
+        if self.table.columnar:
+            return self.table.count(self.filters)
+        cnt = 0
+        for rec in self.iter_recs():
+            cnt += 1
+        return cnt
     def count(self):
-        return len(self.get_rec_list())
+        cnt = self.observed('count', self.count_recs, lambda res: 1)
+        if self.ds.pipe is not None:
+            return self.ds.pipe.resolved(cnt)
+        return cnt
+    def group_by(self, *props):
+        self._group_by = list(props)
+        return self
+    def aggregate(self, **aggregates):
+        """Aggregates given as name=Sum('prop') folded over the matching records
+        in one pass. Returns a dict of them, or with group_by a list of dicts
+        which also hold the group props, ordered by the group props"""
+        names = sorted(aggregates)
+        aggs = [aggregates[name] for name in names]
+        props = self.table.props
+        try:
+            group_pos = [props.index(p) for p in self._group_by]
+            agg_pos = []
+            for agg in aggs:
+                if agg.prop is None:
+                    agg_pos.append(None)
+                else:
+                    agg_pos.append(props.index(agg.prop))
+        except ValueError:
+            raise ORMError("Wrong aggregate props for %s" % self.table.name)
+        steps = zip(range(len(aggs)), [agg.step for agg in aggs], agg_pos)
+        groups = {}
+        for rec in self.iter_recs():
+            key = tuple([rec[i] for i in group_pos])
+            accs = groups.get(key)
+            if accs is None:
+                accs = groups[key] = [agg.start for agg in aggs]
+            for i, step, pos in steps:
+                if pos is None:
+                    accs[i] = step(accs[i], rec)
+                else:
+                    accs[i] = step(accs[i], rec[pos])
+        if not group_pos:
+            return dict(zip(names, groups.get((), [agg.start for agg in aggs])))
+        keys = self._group_by + names
+        return [dict(zip(keys, key + tuple(accs))) for key, accs in sorted(groups.iteritems())]
     def delete(self):
-        map(self.ds.delete, self)
+        """Remove the matching records, no models are built"""
+        self.ds.flush()
+        self.observed('delete', self.delete_recs, lambda res: res)
+        self.ds.table_changed(self.model_cls)
+    def delete_recs(self):
+        table = self.table
+        keys = [key for key, rec in self.get_items()]
+        if self.ds.journal:
+            for key in keys:
+                self.ds.track(table, key)
+        table.remove_many(keys)
+        return len(keys)
     def fetch(self, limit, offset=0):
-        return list(self.__iter__())[offset, limit+offset]
+        return self.observed('fetch', lambda: map(self.make_loader(), self.iter_sorted_recs(limit, offset)), len)
     def fetchone(self):
-        try:
-            return self.__iter__().next()
-        except StopIteration:
-            return None
+        res = self.fetch(limit=1)
+        if res:
+            res = res[0]
+        else:
+            res = None
+        if self.ds.pipe is not None:
+            return self.ds.pipe.resolved(res)
+        return res
     def update(self, param_dict):
-        for row in self:
-            for k, v in param_dict.items():
-                row[k] = v
-            row.save()
+        """Rewrite the matching records in one pass, no models are built.
+        Values may be model.Expression instances, evaluated against the
+        record before the update."""
+        self.ds.flush()
+        self.observed('update', lambda: self.update_recs(param_dict), lambda res: res)
+        self.ds.table_changed(self.model_cls)
+    def update_recs(self, param_dict):
+        table = self.table
+        props = table.props
+        try:
+            assignments = [(props.index(p), as_expression(v).evaluator(props)) for p, v in param_dict.iteritems()]
+        except ValueError:
+            raise ORMError("Wrong update props for %s" % table.name)
+        key_pos = [props.index(k) for k in self.model_cls._meta.key]
+        journal = self.ds.journal
+        items = self.get_items()
+        if not set(key_pos) & set([pos for pos, evaluate in assignments]):
+            for key, rec in items:
+                new = list(rec)
+                for pos, evaluate in assignments:
+                    new[pos] = evaluate(rec)
+                if journal:
+                    self.ds.track(table, key)
+                table.put(key, tuple(new))
+            return len(items)
+        # primary key assigned: remove all the old records before putting the
+        # moved ones, so that a key taken over from another matching record
+        # is not lost
+        moved = []
+        for key, rec in items:
+            new = list(rec)
+            for pos, evaluate in assignments:
+                new[pos] = evaluate(rec)
+            if len(key_pos) > 1:
+                new_key = tuple([new[i] for i in key_pos])
+            else:
+                new_key = new[key_pos[0]]
+            moved.append((new_key, tuple(new)))
+        if journal:
+            for key, rec in items:
+                self.ds.track(table, key)
+        table.remove_many([key for key, rec in items])
+        for key, rec in moved:
+            if journal:
+                self.ds.track(table, key)
+            table.put(key, rec)
+        return len(items)
 
 class Table(object):
+    columnar = False
     def __init__(self, name, key, props):
         self.name = name
         self.props = props
         self.key = key
         self.data = {}
+        self.indexes = {}
+    def __setstate__(self, state):
+        # tables pickled before indexes were introduced
+        self.__dict__.update(state)
+        self.__dict__.setdefault('indexes', {})
+    def load_rows(self, keys, recs):
+        """Fill an empty table before indexes are added"""
+        self.data = dict(zip(keys, recs))
+    def add_index(self, prop, kind='hash'):
+        if prop in self.indexes:
+            return self.indexes[prop]
+        if kind not in index_types:
+            raise ORMError("Unknown index type %s" % repr(kind))
+        index = index_types[kind](prop, self.props.index(prop))
+        index.build(self.data.iteritems())
+        self.indexes[prop] = index
+        return index
+    def drop_index(self, prop):
+        del self.indexes[prop]
+    def index_spec(self):
+        return dict([(prop, index.kind) for prop, index in self.indexes.iteritems()])
+    def update_indexes(self, key, old, rec):
+        """Replace record old (None for a new key) by rec (None to remove)
+        in every index. All indexes change or, if one raises, none does."""
+        done = []
+        try:
+            for index in self.indexes.itervalues():
+                if old is not None:
+                    index.remove(key, old)
+                    done.append((index, old, False))
+                if rec is not None:
+                    index.insert(key, rec)
+                    done.append((index, rec, True))
+        except:
+            for index, r, inserted in reversed(done):
+                if inserted:
+                    index.remove(key, r)
+                else:
+                    index.insert(key, r)
+            raise
+    def put(self, key, rec):
+        self.update_indexes(key, self.data.get(key), rec)
+        self.data[key] = rec
+    def remove(self, key):
+        rec = self.data.get(key)
+        if rec is not None:
+            self.update_indexes(key, rec, None)
+            del self.data[key]
+    def remove_many(self, keys):
+        data = self.data
+        items = [(key, data.pop(key)) for key in keys if key in data]
+        for index in self.indexes.itervalues():
+            index.remove_many(items)
+    def lookup(self, filters):
+        """Candidate keys from the most selective index usable for filters,
+        or None if no index applies. Candidates still must be checked against
+        all conditions."""
+        best, best_cnt = None, None
+        for prop_name, op, value in filters:
+            index = self.indexes.get(prop_name)
+            if index is None or op not in index.ops:
+                continue
+            cnt = index.estimate(op, value)
+            if best_cnt is None or cnt < best_cnt:
+                best, best_cnt = (index, op, value), cnt
+        if best is None:
+            return None
+        index, op, value = best
+        return index.lookup(op, value)
+
+def value_kind(value):
+    """Storage mode of a Column able to hold value"""
+    if isinstance(value, bool):
+        return 'object'
+    if isinstance(value, (int, long)):
+        if -2**63 <= value < 2**63:
+            return 'int'
+        return 'object'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return 'datetime'
+        return 'object'
+    if isinstance(value, basestring):
+        # equal str and unicode values share one dictionary code
+        return 'string'
+    return 'object'
+
+column_dtypes = {
+    'int': 'i8',
+    'float': 'f8',
+    'datetime': 'M8[us]',
+    'string': 'i4',
+    'object': object,
+}
+
+numpy_ops = {
+    '=' : operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<' : operator.lt,
+    '<=': operator.le,
+    '>' : operator.gt,
+    '>=': operator.ge,
+}
+
+def resized(arr, capacity, fill):
+    res = numpy.empty(capacity, arr.dtype)
+    n = min(len(arr), capacity)
+    res[:n] = arr[:n]
+    res[n:] = fill
+    return res
+
+class Column(object):
+    """Values of one property of a ColumnarTable.
+
+    The storage mode is chosen by the first non-null value: numpy arrays for
+    'int', 'float' and 'datetime', dictionary-encoded codes for 'string'
+    (str and unicode). Ints are stored in float columns as floats and a
+    float widens an int column to float, as long as the ints are exact
+    floats. A value of another type switches the column to an 'object'
+    array. Nulls are kept in a separate mask.
+
+    Columns loaded from a columnar snapshot section start with read-only
+    arrays over the mapped file and copy them on the first write.
+    """
+    def __init__(self, capacity=0):
+        self.mode = None
+        self.nulls = numpy.ones(capacity, bool)
+        self.values = None
+        self.dictionary = None
+        self.codes = None
+    def __setstate__(self, state):
+        # columns pickled with separate str and unicode modes
+        self.__dict__.update(state)
+        if self.mode in ('str', 'unicode'):
+            self.mode = 'string'
+    def load(self, mode, values, nulls, extra):
+        """Use arrays read by SnapshotReader.read_columns"""
+        self.mode = mode
+        self.nulls = nulls
+        if mode == 'object':
+            self.values = numpy.empty(len(nulls), object)
+            self.values[:] = values
+        else:
+            self.values = values
+        if mode == 'string':
+            self.dictionary = list(extra)
+            self.codes = dict([(v, code) for code, v in enumerate(self.dictionary)])
+    def section_data(self, positions):
+        """(mode, values, nulls, extra) of the rows at positions for encode_columns"""
+        nulls = self.nulls[positions]
+        if self.mode == 'object':
+            return self.mode, None, nulls, list(self.values[positions])
+        values = None
+        if self.values is not None:
+            values = self.values[positions]
+        return self.mode, values, nulls, self.dictionary
+    def fill_value(self):
+        if self.mode == 'string':
+            return -1
+        elif self.mode == 'object':
+            return None
+        return 0
+    def resize(self, capacity):
+        self.nulls = resized(self.nulls, capacity, True)
+        if self.values is not None:
+            self.values = resized(self.values, capacity, self.fill_value())
+    def take(self, positions):
+        self.nulls = self.nulls[positions]
+        if self.values is not None:
+            self.values = self.values[positions]
+    def start(self, mode):
+        self.mode = mode
+        self.values = numpy.empty(len(self.nulls), column_dtypes[mode])
+        self.values[:] = self.fill_value()
+        if mode == 'string':
+            self.dictionary = []
+            self.codes = {}
+    def widen(self):
+        """Switch an int column to float if its values are exactly representable"""
+        values = self.values[~self.nulls]
+        if len(values) and (values.min() < -2**53 or values.max() > 2**53):
+            return False
+        self.mode = 'float'
+        self.values = self.values.astype(column_dtypes['float'])
+        return True
+    def to_object(self):
+        values = numpy.empty(len(self.nulls), object)
+        for pos in numpy.flatnonzero(~self.nulls):
+            values[pos] = self.get(pos)
+        self.mode = 'object'
+        self.values = values
+        self.dictionary = self.codes = None
+    def encode(self, value):
+        if self.mode == 'string':
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.dictionary)
+                self.dictionary.append(value)
+            return code
+        return value
+    def set(self, pos, value):
+        if not self.nulls.flags.writeable:
+            # mapped from a snapshot
+            self.nulls = self.nulls.copy()
+            if self.values is not None:
+                self.values = self.values.copy()
+        if value is None:
+            self.nulls[pos] = True
+            if self.values is not None:
+                self.values[pos] = self.fill_value()
+            return
+        kind = value_kind(value)
+        if self.mode is None:
+            self.start(kind)
+        elif kind != self.mode and self.mode != 'object':
+            if kind == 'int' and self.mode == 'float' and -2**53 <= value <= 2**53:
+                pass
+            elif kind == 'float' and self.mode == 'int' and self.widen():
+                pass
+            else:
+                self.to_object()
+        self.nulls[pos] = False
+        self.values[pos] = self.encode(value)
+    def get(self, pos):
+        if self.nulls[pos]:
+            return None
+        mode = self.mode
+        if mode == 'int':
+            return int(self.values[pos])
+        elif mode == 'float':
+            return float(self.values[pos])
+        elif mode == 'datetime':
+            return self.values[pos].item()
+        elif mode == 'object':
+            return self.values[pos]
+        return self.dictionary[self.values[pos]]
+    def comparable(self, value):
+        """True if numpy can compare the column values with value directly"""
+        if self.mode in ('int', 'float'):
+            return value_kind(value) in ('int', 'float')
+        elif self.mode == 'datetime':
+            return value_kind(value) == 'datetime'
+        return False
+    def mask(self, op, value, size):
+        """Boolean array of the first size rows matching the condition.
+        Nulls match exactly when the row-wise condition would match None."""
+        nulls = self.nulls[:size]
+        if value is None:
+            if op == '=':
+                return nulls.copy()
+            return ~nulls
+        fn = cmp_map[op]
+        try:
+            null_result = bool(fn(None, value))
+        except TypeError:
+            # e.g. datetime refuses to compare with None
+            null_result = False
+        if self.mode is None:
+            res = numpy.empty(size, bool)
+            res.fill(null_result)
+            return res
+        values = self.values[:size]
+        if self.mode == 'string':
+            # evaluate the condition once per distinct value, code -1 picks the null entry
+            lut = numpy.array([fn(v, value) for v in self.dictionary] + [null_result], bool)
+            return lut[values]
+        if op == 'in':
+            if value and len([v for v in value if not self.comparable(v)]) == 0:
+                res = numpy.in1d(values, numpy.array(list(value), values.dtype))
+                return numpy.where(nulls, null_result, res)
+        elif self.comparable(value):
+            if self.mode == 'datetime':
+                value = numpy.datetime64(value, 'us')
+            return numpy.where(nulls, null_result, numpy_ops[op](values, value))
+        get = self.get
+        return numpy.fromiter((fn(get(i), value) for i in xrange(size)), bool, size)
+
+class ColumnarData(object):
+    """Read-only dict-like key -> record view of a ColumnarTable"""
+    def __init__(self, table):
+        self.table = table
+    def __len__(self):
+        return len(self.table.positions)
+    def __contains__(self, key):
+        return key in self.table.positions
+    def __iter__(self):
+        return iter(self.table.positions)
+    def __getitem__(self, key):
+        return self.table.record(self.table.positions[key])
+    def get(self, key, default=None):
+        pos = self.table.positions.get(key)
+        if pos is None:
+            return default
+        return self.table.record(pos)
+    def keys(self):
+        return self.table.positions.keys()
+    def iterkeys(self):
+        return iter(self.table.positions)
+    def values(self):
+        return list(self.itervalues())
+    def itervalues(self):
+        record = self.table.record
+        return (record(pos) for pos in self.table.positions.itervalues())
+    def items(self):
+        return list(self.iteritems())
+    def iteritems(self):
+        record = self.table.record
+        return ((key, record(pos)) for key, pos in self.table.positions.iteritems())
+
+class ColumnarTable(Table):
+    """Table storing one Column per property plus a key -> row position map.
+    Query filters are evaluated as boolean masks over whole columns.
+    Deleted rows are left in place and reclaimed once they make up half
+    of the table."""
+    columnar = True
+    def __init__(self, name, key, props):
+        if numpy is None:
+            raise ORMError("Columnar tables require numpy")
+        Table.__init__(self, name, key, props)
+        self.positions = {}
+        self.row_keys = []
+        self.size = 0
+        self.capacity = 0
+        self.alive = numpy.zeros(0, bool)
+        self.columns = [Column() for p in props]
+        self.data = ColumnarData(self)
+    def load_rows(self, keys, recs):
+        for key, rec in zip(keys, recs):
+            self.put(key, rec)
+    def load_columns(self, keys, columns):
+        """Fill an empty table from SnapshotReader.read_columns"""
+        self.row_keys = list(keys)
+        self.positions = dict([(key, pos) for pos, key in enumerate(self.row_keys)])
+        self.size = self.capacity = len(self.row_keys)
+        self.alive = numpy.ones(self.size, bool)
+        for col, data in zip(self.columns, columns):
+            col.load(*data)
+    def encode(self):
+        """Snapshot section of the live rows"""
+        live = numpy.flatnonzero(self.alive[:self.size])
+        return encode_columns([self.row_keys[pos] for pos in live],
+                              [col.section_data(live) for col in self.columns])
+    def record(self, pos):
+        return tuple([col.get(pos) for col in self.columns])
+    def grow(self):
+        self.capacity = max(16, self.capacity * 2)
+        self.alive = resized(self.alive, self.capacity, False)
+        for col in self.columns:
+            col.resize(self.capacity)
+    def put(self, key, rec):
+        pos = self.positions.get(key)
+        if self.indexes:
+            old = None
+            if pos is not None:
+                old = self.record(pos)
+            self.update_indexes(key, old, rec)
+        if pos is None:
+            if self.size == self.capacity:
+                self.grow()
+            pos = self.positions[key] = self.size
+            self.row_keys.append(key)
+            self.size += 1
+            self.alive[pos] = True
+        for col, value in zip(self.columns, rec):
+            col.set(pos, value)
+    def remove(self, key):
+        pos = self.positions.get(key)
+        if pos is None:
+            return
+        if self.indexes:
+            self.update_indexes(key, self.record(pos), None)
+        del self.positions[key]
+        self.alive[pos] = False
+        self.row_keys[pos] = None
+        if self.size > 1024 and len(self.positions) * 2 < self.size:
+            self.vacuum()
+    def remove_many(self, keys):
+        items = []
+        for key in keys:
+            pos = self.positions.pop(key, None)
+            if pos is None:
+                continue
+            if self.indexes:
+                items.append((key, self.record(pos)))
+            self.alive[pos] = False
+            self.row_keys[pos] = None
+        for index in self.indexes.itervalues():
+            index.remove_many(items)
+        if self.size > 1024 and len(self.positions) * 2 < self.size:
+            self.vacuum()
+    def vacuum(self):
+        live = numpy.flatnonzero(self.alive[:self.size])
+        for col in self.columns:
+            col.take(live)
+        self.row_keys = [self.row_keys[pos] for pos in live]
+        self.positions = dict([(key, pos) for pos, key in enumerate(self.row_keys)])
+        self.size = self.capacity = len(live)
+        self.alive = numpy.ones(self.size, bool)
+    def mask(self, filters):
+        mask = self.alive[:self.size].copy()
+        for prop_name, op, value in filters:
+            if op == '<>':
+                op = '!='
+            mask &= self.columns[self.props.index(prop_name)].mask(op, value, self.size)
+        return mask
+    def select(self, filters):
+        """Row positions matching all filters"""
+        return numpy.flatnonzero(self.mask(filters))
+    def count(self, filters):
+        return int(self.mask(filters).sum())
 
 class DataSet(object):
-    def __init__(self, filename=''):
+    """In-memory dataset, optionally persisted to filename.
+
+    By default commit pickles the whole dataset. With journal=True commit
+    appends only the rows changed since the previous commit to
+    filename + '.log' and fsyncs it; once the log grows past compact_size
+    bytes it is folded into the snapshot. Loading reads the snapshot and
+    replays the log.
+
+    columnar=True stores new and loaded tables as ColumnarTable (requires numpy).
+
+    snapshot='mmap' writes snapshots in the memory_snapshot format, where
+    each table is loaded only when a model first touches it. Existing
+    files in that format are detected on load. Row tables are unpickled
+    into the memory of each process. Columnar tables are written as raw
+    arrays, and with columnar=True their int, float, datetime and string
+    code columns are used directly from the mapped file, so processes
+    forked from one another or opening the same file share those pages
+    until a column is changed. Keys, indexes and object columns are
+    always private to the process.
+    """
+    def __init__(self, filename='', journal=False, compact_size=16*1024*1024, snapshot='pickle',
+                 columnar=False):
         self.filename = filename
+        self.columnar = columnar
+        self.journal = journal
+        self.compact_size = compact_size
+        self.snapshot = snapshot
+        # UnitOfWork in deferred mode
+        self.pending = None
+        self.pipe = None
+        # instrument.Observer instances
+        self.observers = []
         self.load(filename)
     def load(self, filename):
+        self.reader = None
+        self.data = {}
         if filename and isfile(filename):
-            f = open(filename, 'r')
-            self.data = pc.load(f)
+            if is_snapshot(filename):
+                self.reader = SnapshotReader(filename)
+                self.snapshot = 'mmap'
+            else:
+                f = open(filename, 'rb')
+                self.data = pc.load(f)
+                f.close()
+        # table name -> {key: record before the first change since commit}
+        self.undo = {}
+        if self.journal and filename:
+            self.replay_log(filename + '.log')
+    def find_table(self, table_name):
+        """Table by name, loading it from the snapshot if needed. None if the
+        table doesn't exist"""
+        table = self.data.get(table_name)
+        if table is None and self.reader is not None and table_name in self.reader:
+            key, props, index_spec = self.reader.info(table_name)
+            table = self.new_table(table_name, key, props)
+            if table.columnar and self.reader.is_columnar(table_name):
+                table.load_columns(*self.reader.read_columns(table_name))
+            else:
+                keys, columns = self.reader.read_table(table_name)
+                if keys:
+                    table.load_rows(keys, zip(*columns))
+            for prop, kind in index_spec.items():
+                table.add_index(prop, kind)
+            self.data[table_name] = table
+        return table
+    def new_table(self, table_name, key, props):
+        if self.columnar:
+            return ColumnarTable(table_name, key, props)
+        return Table(table_name, key, props)
+    def load_all_tables(self):
+        if self.reader is not None:
+            for table_name in self.reader.names():
+                self.find_table(table_name)
+    def replay_log(self, log_filename):
+        if not isfile(log_filename):
+            return
+        f = open(log_filename, 'rb')
+        good_size = 0
+        try:
+            while True:
+                try:
+                    entry = pc.load(f)
+                except EOFError:
+                    break
+                except (pc.UnpicklingError, ValueError, IndexError):
+                    # torn write at the tail of the log, the commit never completed
+                    break
+                for table_name, key, props, index_spec, changes in entry:
+                    table = self.find_table(table_name)
+                    if table is None:
+                        table = self.data[table_name] = self.new_table(table_name, key, props)
+                        for prop, kind in index_spec.items():
+                            table.add_index(prop, kind)
+                    for rec_key, rec in changes.iteritems():
+                        if rec is None:
+                            table.remove(rec_key)
+                        else:
+                            table.put(rec_key, rec)
+                good_size = f.tell()
+        finally:
+            f.close()
+        if good_size < getsize(log_filename):
+            f = open(log_filename, 'r+b')
+            f.truncate(good_size)
             f.close()
+    def track(self, table, key):
+        undo = self.undo.setdefault(table.name, {})
+        if key not in undo:
+            undo[key] = table.data.get(key)
+    def defer(self, enabled=True):
+        """Switch deferred mode, see pg_datasource.DataSet.defer"""
+        if enabled:
+            if self.pending is None:
+                self.pending = UnitOfWork()
         else:
-            self.data = {}
+            self.flush()
+            self.pending = None
+    def flush(self):
+        uow = self.pending
+        if not uow:
+            return
+        self.pending = UnitOfWork()
+        for model_cls, group in group_by_class(uow.new):
+            self.insert_many(model_cls, group)
+            for model in group:
+                if hasattr(model, 'old'):
+                    del model.old
+        for (model_cls, changed), group in uow.changed_groups():
+            for model in group:
+                self.save_now(model)
+        groups = group_by_class(uow.deleted)
+        groups.reverse()
+        for model_cls, group in groups:
+            for model in group:
+                self.delete_now(model)
     def commit(self):
-        if self.filename:
-            f = open(self.filename, 'w')
-            pc.dump(self.data, f)
+        self.flush()
+        if not self.filename:
+            return
+        if not self.journal:
+            self.write_snapshot(self.filename)
+            return
+        entry = []
+        for table_name, undo in self.undo.iteritems():
+            table = self.data[table_name]
+            changes = dict([(key, table.data.get(key)) for key in undo])
+            entry.append((table_name, table.key, table.props, table.index_spec(), changes))
+        self.undo = {}
+        if entry:
+            log_filename = self.filename + '.log'
+            f = open(log_filename, 'ab')
+            pc.dump(entry, f, pc.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            if getsize(log_filename) > self.compact_size:
+                self.compact()
+    def write_snapshot(self, filename):
+        """Write the whole dataset to filename in the snapshot format.
+        Tables not loaded from an mmap snapshot are copied as raw sections."""
+        tmp_filename = filename + '.tmp'
+        f = open(tmp_filename, 'wb')
+        try:
+            if self.snapshot == 'mmap':
+                tables = []
+                for table_name, table in self.data.iteritems():
+                    if table.columnar:
+                        tables.append((table_name, table.key, table.props, table.index_spec(),
+                                       table.encode()))
+                        continue
+                    keys = table.data.keys()
+                    columns = map(list, zip(*[table.data[k] for k in keys]))
+                    if not columns:
+                        columns = [[] for p in table.props]
+                    tables.append((table_name, table.key, table.props, table.index_spec(),
+                                   encode_table(keys, columns)))
+                if self.reader is not None:
+                    for table_name in self.reader.names():
+                        if table_name not in self.data:
+                            key, props, index_spec = self.reader.info(table_name)
+                            tables.append((table_name, key, props, index_spec,
+                                           self.reader.section(table_name)))
+                write_snapshot(f, tables)
+            else:
+                self.load_all_tables()
+                pc.dump(self.data, f, pc.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
             f.close()
+        os.rename(tmp_filename, filename)
+        if filename == self.filename:
+            if self.snapshot == 'mmap':
+                # remaining lazy tables are read from the new file from now on
+                self.reader = SnapshotReader(filename)
+            else:
+                self.reader = None
+    def compact(self):
+        """Write a fresh snapshot and truncate the log. Replaying the log over
+        the new snapshot is harmless, so a crash between the two steps is safe."""
+        self.write_snapshot(self.filename)
+        open(self.filename + '.log', 'wb').close()
     def rollback(self):
-        self.load(self.filename)
+        if self.pending is not None:
+            self.pending = UnitOfWork()
+        if not self.journal:
+            self.load(self.filename)
+            return
+        for table_name, undo in self.undo.iteritems():
+            table = self.data[table_name]
+            for key, rec in undo.iteritems():
+                if rec is None:
+                    table.remove(key)
+                else:
+                    table.put(key, rec)
+        self.undo = {}
     def get_table(self, model_cls):
         table_name = model_cls._table_name
-        if table_name in self.data:
-            return self.data[table_name]
-        props = [p.name for p in model_cls._properties.values() if not p.virtual]
-        table = Table(table_name, model_cls._key, props)
+        table = self.data.get(table_name)
+        if table is not None:
+            return table
+        table = self.find_table(table_name)
+        if table is not None:
+            return table
+        meta = model_cls._meta
+        table = self.new_table(table_name, model_cls._key, list(meta.props))
+        for prop, kind in meta.indexes:
+            table.add_index(prop, kind)
         self.data[table_name] = table
         return table
+    def observed(self, model_cls, operation, params, fn, rows=None):
+        """fn() reported to the observers as operation of model_cls"""
+        if not self.observers:
+            return fn()
+        return observe(self, (model_cls, operation), '%s %s' % (operation, model_cls._table_name),
+                params, fn, (), rows)
     def get(self, model_cls, key):
+        if self.observers:
+            m = self.observed(model_cls, 'get', {'key': key}, lambda: self.get_now(model_cls, key),
+                    lambda m: int(m is not None))
+        else:
+            m = self.get_now(model_cls, key)
+        if self.pipe is not None:
+            return self.pipe.resolved(m)
+        return m
+    def get_now(self, model_cls, key):
         table = self.get_table(model_cls)
         rec = table.data.get(key)
         if rec is None:
             return None
-        vals = dict(zip(table.props, rec))
-        m =  model_cls(self, **vals)
-        m.saved = True
-        return m
+        return model_cls._meta.loader(table.props)(self, rec)
+    def get_many(self, model_cls, keys):
+        if self.observers:
+            keys = list(keys)
+            return self.observed(model_cls, 'get_many', {'keys': keys}, lambda: self.get_many_now(model_cls, keys),
+                    lambda res: len([m for m in res if m is not None]))
+        return self.get_many_now(model_cls, keys)
+    def get_many_now(self, model_cls, keys):
+        table = self.get_table(model_cls)
+        data = table.data
+        load = model_cls._meta.loader(table.props)
+        res = []
+        for key in keys:
+            rec = data.get(key)
+            if rec is None:
+                res.append(None)
+            else:
+                res.append(load(self, rec))
+        return res
     def save(self, model):
+        if self.pending is not None:
+            self.pending.save(model)
+            return
+        if self.observers:
+            self.observed(type(model), 'save', None, lambda: self.save_now(model), lambda res: 1)
+        else:
+            self.save_now(model)
+    def save_now(self, model):
         table = self.get_table(model)
-        if ',' in model._key:
-            key = tuple(model[k] for k in model._key.split(','))
+        key_props = model._meta.key
+        if len(key_props) > 1:
+            key = tuple([model[k] for k in key_props])
+            orig_key = tuple([model.original(k) for k in key_props])
         else:
             key = model[model._key]
-        if key in table.data:
-            rec = list(table.data[key])
-            for i, p in enumerate(table.props):
-                if model.data.get(p) != rec[i]:
-                    rec[i] = model.data.get(p)
+            orig_key = model.original(model._key)
+        if model.saved and orig_key != key and orig_key in table.data:
+            # primary key changed, move the record
+            if self.journal:
+                self.track(table, orig_key)
+            table.remove(orig_key)
+        rec = table.data.get(key)
+        if rec is not None:
+            rec = list(rec)
+            if model.saved:
+                # only assigned properties can differ from the stored record
+                for p in model.changed_props():
+                    rec[table.props.index(p)] = model.data.get(p)
+            else:
+                for i, p in enumerate(table.props):
+                    if model.data.get(p) != rec[i]:
+                        rec[i] = model.data.get(p)
             rec = tuple(rec)
             if hasattr(model, 'old'):
                 del model.old
         else:
             rec = tuple(model[p] for p in table.props)
-        table.data[key] = rec
+        if self.journal:
+            self.track(table, key)
+        table.put(key, rec)
+    def save_many(self, models):
+        """Batch counterpart of pg_datasource.DataSet.save_many: new models
+        are put into their table directly, saved models go through save"""
+        for model in models:
+            model.before_save()
+        if self.pending is not None:
+            for model in models:
+                self.pending.save(model)
+                model.saved = True
+            return
+        for model_cls, group in group_by_class(models):
+            new = []
+            for model in group:
+                if model.saved:
+                    self.save_now(model)
+                else:
+                    new.append(model)
+            self.insert_many(model_cls, new)
+            for model in new:
+                model.saved = True
+    def insert_many(self, model_cls, models):
+        table = self.get_table(model_cls)
+        key_props = model_cls._meta.key
+        props = table.props
+        for model in models:
+            if len(key_props) > 1:
+                key = tuple([model[k] for k in key_props])
+            else:
+                key = model[key_props[0]]
+            if self.journal:
+                self.track(table, key)
+            table.put(key, tuple([model[p] for p in props]))
     def delete(self, model):
+        if self.pending is not None:
+            self.pending.delete(model)
+            return
+        if self.observers:
+            self.observed(type(model), 'delete', None, lambda: self.delete_now(model), lambda res: 1)
+        else:
+            self.delete_now(model)
+    def delete_now(self, model):
         table = self.get_table(model)
-        if ',' in model._key:
-            key = tuple(model[k] for k in model._key.split(','))
+        if len(model._meta.key) > 1:
+            key = tuple([model[k] for k in model._meta.key])
         else:
             key = model[model._key]
-        if key in table.data:
-            del table.data[key]
+        if self.journal:
+            self.track(table, key)
+        table.remove(key)
+    query_class = Query
     def query(self, model_class, props):
-        return Query(model_class, self, props)
+        return self.query_class(model_class, self, props)
+    def table_changed(self, model_cls):
+        """Called after rows of model_cls were changed in bulk by a Query"""
+        pass
+    def pipeline(self):
+        """No-op counterpart of pg_datasource.DataSet.pipeline"""
+        return Pipeline(self)
+
 
+def convert_pickle(pickle_filename, snapshot_filename):
+    """Convert a dataset file written by pickle to the mmap snapshot format"""
+    ds = DataSet(pickle_filename)
+    ds.snapshot = 'mmap'
+    ds.write_snapshot(snapshot_filename)
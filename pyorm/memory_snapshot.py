@@ -0,0 +1,157 @@
+"""Snapshot file format for memory_datasource.
+
+    header     MAGIC, directory offset and length
+    sections   one per table, 8-byte aligned: pickled (keys, columns), a
+               list of keys and one list of values per table property, or
+               a columnar section
+    directory  pickled {table name: (offset, length, key, props, index_spec)}
+
+A ColumnarTable is written as a columnar section:
+
+    COLUMNS_MAGIC, length of the pickled header
+    header     pickled (keys, [(mode, values, nulls, extra)]) where values
+               and nulls are (offset from the end of the header, dtype) of
+               raw arrays, or None, and extra is the dictionary of a 'string'
+               column or the values of an 'object' column
+    arrays     raw numpy arrays, 8-byte aligned
+
+The file is memory-mapped read-only, so only the directory is decoded on
+open and a table section is read when the table is first used. Pickled
+sections are unpickled into private memory of each process. The raw
+arrays of a columnar section are used in place through numpy.frombuffer,
+so processes mapping the same file share their pages through the page
+cache until a column is written to.
+"""
+
+import mmap
+import struct
+import cPickle as pc
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'PYORMSN1'
+HEADER = '<8sQQ'
+HEADER_SIZE = struct.calcsize(HEADER)
+COLUMNS_MAGIC = 'PYORMCO1'
+COLUMNS_HEADER = '<8sQ'
+COLUMNS_HEADER_SIZE = struct.calcsize(COLUMNS_HEADER)
+
+def padding(length):
+    return '\0' * (-length % 8)
+
+def is_snapshot(filename):
+    f = open(filename, 'rb')
+    head = f.read(len(MAGIC))
+    f.close()
+    return head == MAGIC
+
+def encode_table(keys, columns):
+    return pc.dumps((keys, columns), pc.HIGHEST_PROTOCOL)
+
+def encode_columns(keys, columns):
+    """Columnar section of a table.
+    columns: list of (mode, values, nulls, extra) where values and nulls are
+    numpy arrays of len(keys) items or None"""
+    arrays = []
+    offset = [0]
+    def add(arr):
+        if arr is None:
+            return None
+        data = arr.tostring()
+        res = (offset[0], arr.dtype.str)
+        arrays.append(data + padding(len(data)))
+        offset[0] += len(arrays[-1])
+        return res
+    spec = [(mode, add(values), add(nulls), extra) for mode, values, nulls, extra in columns]
+    header = pc.dumps((keys, spec), pc.HIGHEST_PROTOCOL)
+    return ''.join([struct.pack(COLUMNS_HEADER, COLUMNS_MAGIC, len(header)), header,
+                    padding(COLUMNS_HEADER_SIZE + len(header))] + arrays)
+
+def write_snapshot(f, tables):
+    """Write tables to file object f.
+    tables: iterable of (name, key, props, index_spec, section) where section
+    is the result of encode_table, encode_columns or a raw section of
+    another snapshot"""
+    f.write(struct.pack(HEADER, MAGIC, 0, 0))
+    offset = HEADER_SIZE
+    directory = {}
+    for name, key, props, index_spec, section in tables:
+        f.write(section)
+        directory[name] = (offset, len(section), key, props, index_spec)
+        offset += len(section)
+        f.write(padding(offset))
+        offset += len(padding(offset))
+    dir_data = pc.dumps(directory, pc.HIGHEST_PROTOCOL)
+    f.write(dir_data)
+    f.seek(0)
+    f.write(struct.pack(HEADER, MAGIC, offset, len(dir_data)))
+    f.seek(0, 2)
+
+class SnapshotReader(object):
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, dir_offset, dir_length = struct.unpack(HEADER, self.map[:HEADER_SIZE])
+        if magic != MAGIC:
+            raise ValueError("%s is not a pyorm snapshot" % filename)
+        self.directory = pc.loads(self.map[dir_offset:dir_offset + dir_length])
+    def __contains__(self, name):
+        return name in self.directory
+    def names(self):
+        return self.directory.keys()
+    def info(self, name):
+        """(key, props, index_spec) of the table"""
+        offset, length, key, props, index_spec = self.directory[name]
+        return key, props, index_spec
+    def section(self, name):
+        offset, length = self.directory[name][:2]
+        return self.map[offset:offset + length]
+    def is_columnar(self, name):
+        offset = self.directory[name][0]
+        return self.map[offset:offset + len(COLUMNS_MAGIC)] == COLUMNS_MAGIC
+    def read_table(self, name):
+        """(keys, columns) of the table, with a list of values per column"""
+        if self.is_columnar(name):
+            keys, columns = self.read_columns(name)
+            res = []
+            for mode, values, nulls, extra in columns:
+                if mode == 'string':
+                    values = [extra[code] for code in values]
+                elif mode in ('int', 'float', 'datetime'):
+                    values = values.tolist()
+                res.append([None if null else value for value, null in zip(values, nulls)])
+            return keys, res
+        return pc.loads(self.section(name))
+    def read_columns(self, name):
+        """(keys, [(mode, values, nulls, extra)]) of a columnar section.
+        values and nulls are read-only numpy arrays over the mapped file,
+        values of an 'object' column are the list in extra."""
+        offset = self.directory[name][0]
+        magic, header_length = struct.unpack(COLUMNS_HEADER,
+                self.map[offset:offset + COLUMNS_HEADER_SIZE])
+        start = offset + COLUMNS_HEADER_SIZE
+        keys, spec = pc.loads(self.map[start:start + header_length])
+        start += header_length
+        start += len(padding(start - offset))
+        count = len(keys)
+        columns = []
+        def array(spec):
+            array_offset, dtype = spec
+            if not count:
+                return numpy.empty(0, dtype)
+            return numpy.frombuffer(self.map, dtype, count, start + array_offset)
+        columns = []
+        for mode, values, nulls, extra in spec:
+            if values is not None:
+                values = array(values)
+            elif mode == 'object':
+                values = extra
+            columns.append((mode, values, array(nulls), extra))
+        return keys, columns
+    def close(self):
+        self.map.close()
@@ -1,14 +1,289 @@
 
-import copy
+import base64
+import binascii
+import json
+import operator
+from datetime import date, datetime
+from decimal import Decimal
 
 class ORMError(Exception): pass
 class FilterError(ORMError): pass
 
+# original value of a property which was not in model data
+MISSING = object()
+
+def group_by_class(models):
+    """[(model class, [models])] in order of first appearance"""
+    groups = {}
+    res = []
+    for model in models:
+        cls = type(model)
+        if cls not in groups:
+            groups[cls] = []
+            res.append((cls, groups[cls]))
+        groups[cls].append(model)
+    return res
+
+def encode_token(values):
+    """Opaque url-safe page token of the values of the last row of a page"""
+    res = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = {'datetime': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+        elif isinstance(value, date):
+            value = {'date': value.strftime('%Y-%m-%d')}
+        elif isinstance(value, Decimal):
+            value = {'decimal': str(value)}
+        res.append(value)
+    return base64.urlsafe_b64encode(json.dumps(res, separators=(',', ':')))
+
+def decode_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+        res = []
+        for value in values:
+            if isinstance(value, dict):
+                if 'datetime' in value:
+                    value = datetime.strptime(value['datetime'], '%Y-%m-%dT%H:%M:%S.%f')
+                elif 'date' in value:
+                    value = datetime.strptime(value['date'], '%Y-%m-%d').date()
+                else:
+                    value = Decimal(value['decimal'])
+            res.append(value)
+        return res
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise ORMError("Wrong page token: %r" % token)
+
+class UnitOfWork(object):
+    """Models saved or deleted through a DataSet in deferred mode, waiting
+    for DataSet.flush. Each model is registered once, as new, dirty or deleted."""
+    def __init__(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+        self.states = {}
+    def __len__(self):
+        return len(self.states)
+    def save(self, model):
+        state = self.states.get(id(model))
+        if state == 'deleted':
+            raise ORMError("Can't save deleted instance %s" % repr(model))
+        elif state is None:
+            if model.saved:
+                self.dirty.append(model)
+                self.states[id(model)] = 'dirty'
+            else:
+                self.new.append(model)
+                self.states[id(model)] = 'new'
+    def delete(self, model):
+        state = self.states.get(id(model))
+        if state == 'new':
+            # never reached the database
+            self.new.remove(model)
+            del self.states[id(model)]
+            return
+        elif state == 'dirty':
+            self.dirty.remove(model)
+        elif state == 'deleted':
+            return
+        self.deleted.append(model)
+        self.states[id(model)] = 'deleted'
+    def changed_groups(self):
+        """[((model class, changed props), [models])] for dirty models with changes"""
+        groups = {}
+        res = []
+        for model in self.dirty:
+            if not model.changed:
+                continue
+            changed = tuple(model.changed_props())
+            if not changed:
+                del model.old
+                continue
+            key = (type(model), changed)
+            if key not in groups:
+                groups[key] = []
+                res.append((key, groups[key]))
+            groups[key].append(model)
+        return res
+
+class Future(object):
+    """Result of a call made inside DataSet.pipeline(), available as value
+    once the pipeline has run"""
+    def __init__(self):
+        self.done = False
+        self.result = None
+    def set(self, result):
+        self.result = result
+        self.done = True
+    @property
+    def value(self):
+        if not self.done:
+            raise ORMError("Pipeline has not been executed yet")
+        return self.result
+
+class Pipeline(object):
+    """Context in which DataSet.get, Query.count and Query.fetchone return
+    Futures. This base implementation resolves them immediately."""
+    def __init__(self, ds):
+        self.ds = ds
+    def __enter__(self):
+        if self.ds.pipe is not None:
+            raise ORMError("Pipeline is already active")
+        self.ds.pipe = self
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.ds.pipe = None
+        if exc_type is None:
+            self.run()
+        return False
+    def resolved(self, result):
+        future = Future()
+        future.set(result)
+        return future
+    def run(self):
+        pass
+
+class Aggregate(object):
+    """Aggregate of Query.aggregate. Postgres compiles it to func(field),
+    the memory datasource folds values with step, starting from start"""
+    func = None
+    start = None
+    def __init__(self, prop):
+        self.prop = prop
+    def sql(self, fieldnames):
+        return '%s(%s)' % (self.func, fieldnames[self.prop])
+    def step(self, acc, value):
+        raise NotImplementedError
+    def combine(self, a, b):
+        """Aggregate of two partial results"""
+        return self.step(a, b)
+
+class Count(Aggregate):
+    """Number of rows, or of non-null values of prop"""
+    func = 'count'
+    start = 0
+    def __init__(self, prop=None):
+        self.prop = prop
+    def sql(self, fieldnames):
+        if self.prop is None:
+            return 'count(1)'
+        return Aggregate.sql(self, fieldnames)
+    def step(self, acc, value):
+        if value is None and self.prop is not None:
+            return acc
+        return acc + 1
+    def combine(self, a, b):
+        return a + b
+
+class Sum(Aggregate):
+    func = 'sum'
+    def step(self, acc, value):
+        if value is None:
+            return acc
+        if acc is None:
+            return value
+        return acc + value
+
+class Min(Aggregate):
+    func = 'min'
+    def step(self, acc, value):
+        if value is None or (acc is not None and acc <= value):
+            return acc
+        return value
+
+class Max(Aggregate):
+    func = 'max'
+    def step(self, acc, value):
+        if value is None or (acc is not None and acc >= value):
+            return acc
+        return value
+
+class Expression(object):
+    """Value of Query.update computed from the row being updated, built from
+    F(prop), constants and + - * /. pg_datasource compiles it to SQL, the
+    memory datasource evaluates it per record. None propagates like null."""
+    def __add__(self, other):
+        return BinOp('+', self, other)
+    def __radd__(self, other):
+        return BinOp('+', other, self)
+    def __sub__(self, other):
+        return BinOp('-', self, other)
+    def __rsub__(self, other):
+        return BinOp('-', other, self)
+    def __mul__(self, other):
+        return BinOp('*', self, other)
+    def __rmul__(self, other):
+        return BinOp('*', other, self)
+    def __div__(self, other):
+        return BinOp('/', self, other)
+    def __rdiv__(self, other):
+        return BinOp('/', other, self)
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+    def sql(self, fieldnames, param):
+        """SQL of the expression, param(value) returns the placeholder of a constant"""
+        raise NotImplementedError
+    def evaluator(self, props):
+        """Function of a record with props computing the expression"""
+        raise NotImplementedError
+
+def as_expression(value):
+    if isinstance(value, Expression):
+        return value
+    return Value(value)
+
+class F(Expression):
+    """Current value of prop"""
+    def __init__(self, prop):
+        self.prop = prop
+    def sql(self, fieldnames, param):
+        try:
+            return fieldnames[self.prop]
+        except KeyError:
+            raise ORMError("Wrong property name %s in expression" % self.prop)
+    def evaluator(self, props):
+        try:
+            return operator.itemgetter(props.index(self.prop))
+        except ValueError:
+            raise ORMError("Wrong property name %s in expression" % self.prop)
+
+class Value(Expression):
+    def __init__(self, value):
+        self.value = value
+    def sql(self, fieldnames, param):
+        return param(self.value)
+    def evaluator(self, props):
+        value = self.value
+        return lambda rec: value
+
+binary_ops = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+
+class BinOp(Expression):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = as_expression(left)
+        self.right = as_expression(right)
+    def sql(self, fieldnames, param):
+        return '(%s %s %s)' % (self.left.sql(fieldnames, param), self.op, self.right.sql(fieldnames, param))
+    def evaluator(self, props):
+        fn = binary_ops[self.op]
+        left = self.left.evaluator(props)
+        right = self.right.evaluator(props)
+        def evaluate(rec):
+            a = left(rec)
+            b = right(rec)
+            if a is None or b is None:
+                return None
+            return fn(a, b)
+        return evaluate
+
 class Property(object):
     virtual = False
-    def __init__(self, fieldname=None, default=None, virtual=False):
+    def __init__(self, fieldname=None, default=None, virtual=False, index=None):
         self.fieldname = fieldname
         self.default = default
+        # index type for in-memory tables: 'hash' or 'sorted'
+        self.index = index
         if virtual:
             self.virtual = virtual
     def init_property(self, cls, name):
@@ -18,12 +293,203 @@ class Property(object):
     def __get__(self, instance, owner):
         return instance.data.get(self.name, self.default)
     def __set__(self, instance, value):
-        if not hasattr(instance, 'old'):
-            instance.old = copy.copy(instance.data)
+        # remember the original value of the first assignment only
+        old = getattr(instance, 'old', None)
+        if old is None:
+            old = instance.old = {}
+        if self.name not in old:
+            old[self.name] = instance.data.get(self.name, MISSING)
         instance.data[self.name] = value
 
+class CompactProperty(object):
+    """Replaces a Property in compact models: the value is kept in the
+    instance's _values list at the property position"""
+    __slots__ = ('prop', 'name', 'pos', 'default')
+    def __init__(self, prop, pos):
+        # name is set by ModelMetaclass
+        self.prop = prop
+        self.name = None
+        self.pos = pos
+        self.default = prop.default
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.prop
+        value = instance._values[self.pos]
+        if value is MISSING:
+            return self.default
+        return value
+    def __set__(self, instance, value):
+        old = getattr(instance, 'old', None)
+        if old is None:
+            old = instance.old = {}
+        if self.name not in old:
+            old[self.name] = instance._values[self.pos]
+        instance._values[self.pos] = value
+
+class CompactData(object):
+    """Live dict-like view of the data of a compact model"""
+    __slots__ = ('model',)
+    def __init__(self, model):
+        self.model = model
+    def get(self, name, default=None):
+        pos = self.model._positions.get(name)
+        if pos is None:
+            return (self.model._extra or {}).get(name, default)
+        value = self.model._values[pos]
+        if value is MISSING:
+            return default
+        return value
+    def __getitem__(self, name):
+        value = self.get(name, MISSING)
+        if value is MISSING:
+            raise KeyError(name)
+        return value
+    def __setitem__(self, name, value):
+        pos = self.model._positions.get(name)
+        if pos is None:
+            if self.model._extra is None:
+                self.model._extra = {}
+            self.model._extra[name] = value
+        else:
+            self.model._values[pos] = value
+    def __contains__(self, name):
+        return self.get(name, MISSING) is not MISSING
+    def pop(self, name, default=None):
+        value = self.get(name, MISSING)
+        if value is MISSING:
+            return default
+        pos = self.model._positions.get(name)
+        if pos is None:
+            del self.model._extra[name]
+        else:
+            self.model._values[pos] = MISSING
+        return value
+    def iteritems(self):
+        values = self.model._values
+        for name, pos in self.model._positions.iteritems():
+            if values[pos] is not MISSING:
+                yield name, values[pos]
+        if self.model._extra:
+            for item in self.model._extra.iteritems():
+                yield item
+    def items(self):
+        return list(self.iteritems())
+    def keys(self):
+        return [name for name, value in self.iteritems()]
+    def values(self):
+        return [value for name, value in self.iteritems()]
+    def __iter__(self):
+        return iter(self.keys())
+    def __len__(self):
+        return len(self.keys())
+    def copy(self):
+        return dict(self.iteritems())
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+def get_compact_data(model):
+    return CompactData(model)
+
+def set_compact_data(model, data):
+    get = data.get
+    values = [get(name, MISSING) for name in model._names]
+    extra = None
+    if len(data) + values.count(MISSING) != len(values):
+        extra = dict([(name, value) for name, value in data.iteritems() if name not in model._positions])
+    model._values = values
+    model._extra = extra
+
+class ModelMeta(object):
+    """Metadata of a model class compiled once by ModelMetaclass: column
+    lists, SQL templates and row loaders. Datasources use it instead of
+    walking _properties on every call."""
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        properties = model_cls._properties
+        if model_cls._compact:
+            names = model_cls._names
+        else:
+            names = sorted(properties)
+        self.props = tuple([p for p in names if not properties[p].virtual])
+        self.fieldnames = dict([(p, prop.fieldname) for p, prop in properties.iteritems()])
+        self.fields = tuple([self.fieldnames[p] for p in self.props])
+        self.indexes = [(p, properties[p].index) for p in self.props if properties[p].index]
+        self.table = getattr(model_cls, '_table_name', None)
+        key = getattr(model_cls, '_key', None)
+        self.key = key and tuple(key.split(',')) or ()
+        self.key_fields = tuple([self.fieldnames.get(p, p) for p in self.key])
+        if self.table and self.key:
+            self.pk_cond = ' and '.join(['%s=%%(pk_%s)s' % (f, f) for f in self.key_fields])
+            self.select_sql = 'select %s from %s' % (', '.join(self.fields), self.table)
+            self.get_sql = '%s where %s' % (self.select_sql, self.pk_cond)
+            self.insert_sql = 'insert into %s (%s)\n  values (%s)' % (self.table,
+                    ','.join(self.fields), ','.join(['%%(%s)s' % p for p in self.props]))
+            self.delete_sql = 'delete from %s where %s' % (self.table, self.pk_cond)
+        self.update_sqls = {}
+        self.field_lists = {}
+        self.loaders = {}
+    def key_params(self, get):
+        """pk_<field> parameters of pk_cond, get(prop) returns a key value"""
+        return dict([('pk_' + f, get(p)) for p, f in zip(self.key, self.key_fields)])
+    def update_sql(self, changed):
+        """Update of the changed props, with %(prop)s and pk_cond parameters"""
+        changed = tuple(changed)
+        sql = self.update_sqls.get(changed)
+        if sql is None:
+            sql = self.update_sqls[changed] = '\n'.join(['update %s set' % self.table,
+                    ',\n'.join(['%s=%%(%s)s' % (self.fieldnames[p], p) for p in changed]),
+                    'where', self.pk_cond])
+        return sql
+    def field_list(self, props):
+        """Comma separated field names of props"""
+        props = tuple(props)
+        res = self.field_lists.get(props)
+        if res is None:
+            res = self.field_lists[props] = ', '.join([self.fieldnames[p] for p in props])
+        return res
+    def loader(self, props=None, row_props=None):
+        """Function load(session, row) returning a saved model with props
+        (all by default) taken from row, a sequence of row_props values
+        (props by default). Generated once per projection."""
+        props = tuple(props or self.props)
+        row_props = tuple(row_props or props)
+        load = self.loaders.get((props, row_props))
+        if load is None:
+            load = self.loaders[(props, row_props)] = self.compile_loader(props, row_props)
+        return load
+    def compile_loader(self, props, row_props):
+        cls = self.model_cls
+        columns = dict([(p, 'row[%d]' % row_props.index(p)) for p in props])
+        env = {'cls': cls, 'new': object.__new__, 'MISSING': MISSING}
+        if cls.__init__.im_func is not Model.__init__.im_func or \
+                (cls._compact and [p for p in props if p not in cls._positions]):
+            # custom constructor, go through it
+            body = ['m = cls(session, %s)' % ', '.join(['%s=%s' % (p, columns[p]) for p in props])]
+        elif cls._compact:
+            body = ['m = new(cls)', 'm.session = session',
+                    'm._values = [%s]' % ', '.join([columns.get(p, 'MISSING') for p in cls._names]),
+                    'm._extra = None']
+        else:
+            body = ['m = new(cls)', 'm.session = session',
+                    'm.data = {%s}' % ', '.join(['%r: %s' % (p, columns[p]) for p in props])]
+        body.extend(['m.saved = True', 'return m'])
+        exec 'def load(session, row):\n    ' + '\n    '.join(body) in env
+        return env['load']
+
 class ModelMetaclass(type):
+    """Collects _properties, including inherited ones.
+
+    With _compact = True in the class body (inherited by subclasses) instances
+    get __slots__ and keep property values in one list indexed by position
+    instead of a data dict; model.data becomes a live CompactData view.
+    """
     def __new__(model_metaclass, model_class_name, model_class_base, model_attrs):
+        if model_attrs.get('_compact', False) or [b for b in model_class_base if getattr(b, '_compact', False)]:
+            model_attrs = model_metaclass.compact_attrs(model_class_base, model_attrs)
         model_class = type.__new__(model_metaclass, model_class_name, model_class_base, model_attrs)
         properties = {}
         if hasattr(model_class, '_properties'):
@@ -33,11 +499,41 @@ class ModelMetaclass(type):
             if isinstance(attr, Property):
                 attr.init_property(model_class, attr_name)
                 model_class._properties[attr_name] = attr
+            elif isinstance(attr, CompactProperty):
+                attr.prop.init_property(model_class, attr_name)
+                attr.name = attr_name
+                model_class._properties[attr_name] = attr.prop
+        model_class._meta = ModelMeta(model_class)
         return model_class
+    @staticmethod
+    def compact_attrs(bases, attrs):
+        attrs = dict(attrs)
+        base_compact = [b for b in bases if getattr(b, '_compact', False)]
+        positions = {}
+        if base_compact:
+            positions.update(base_compact[0]._positions)
+        else:
+            attrs['__slots__'] = ('session', 'saved', 'old', '_values', '_extra')
+            attrs['data'] = property(get_compact_data, set_compact_data)
+        if base_compact and '__slots__' not in attrs:
+            attrs['__slots__'] = ()
+        for name in sorted(attrs.keys()):
+            attr = attrs[name]
+            if isinstance(attr, Property):
+                pos = positions.get(name)
+                if pos is None:
+                    pos = positions[name] = len(positions)
+                attrs[name] = CompactProperty(attr, pos)
+        attrs['_positions'] = positions
+        attrs['_names'] = tuple(sorted(positions, key=positions.get))
+        attrs['_compact'] = True
+        return attrs
 
 class Model(object):
     __metaclass__ = ModelMetaclass
+    __slots__ = ()
     _default_props = None
+    _compact = False
     def __init__(self, session, **kwargs):
         self.session = session
         self.data = kwargs
@@ -48,6 +544,30 @@ class Model(object):
     @property
     def changed(self):
         return hasattr(self, 'old')
+    def original(self, name):
+        """Value of the property before the first assignment since load or save"""
+        old = getattr(self, 'old', None)
+        if old is not None and name in old:
+            value = old[name]
+            if value is MISSING:
+                return None
+            return value
+        return self.data.get(name)
+    def changed_props(self):
+        """Sorted names of assigned non-virtual properties whose value differs
+        from the original one"""
+        old = getattr(self, 'old', None)
+        if not old:
+            return []
+        res = []
+        data = self.data
+        for name, value in old.iteritems():
+            if value is MISSING:
+                value = None
+            if data.get(name) != value and not self._properties[name].virtual:
+                res.append(name)
+        res.sort()
+        return res
     @classmethod
     def get_from(cls):
         return "from " + cls._table_name
@@ -55,6 +575,12 @@ class Model(object):
     def get(cls, dataset, key):
         return dataset.get(cls, key)
     @classmethod
+    def get_many(cls, dataset, keys):
+        return dataset.get_many(cls, keys)
+    @classmethod
+    def save_many(cls, dataset, models):
+        dataset.save_many(models)
+    @classmethod
     def query(cls, dataset, props=''):
         return dataset.query(cls, props)
     def before_save(self):
@@ -64,8 +590,13 @@ class Model(object):
         self.session.save(self)
         self.saved = True
     def cancel(self):
-        if hasattr(self, 'old'):
-            self.data = self.old
+        old = getattr(self, 'old', None)
+        if old is not None:
+            for name, value in old.iteritems():
+                if value is MISSING:
+                    self.data.pop(name, None)
+                else:
+                    self.data[name] = value
             del self.old
     def delete(self):
         if self.saved:
@@ -1,18 +1,153 @@
-from model import FilterError
+import re
+from functools import partial
+from itertools import imap
+from cStringIO import StringIO
+from datetime import date, time, datetime
+from decimal import Decimal
+from instrument import observe
+from model import ORMError, FilterError, Future, Pipeline, UnitOfWork, Expression, group_by_class, \
+        encode_token, decode_token
+try:
+    from collections import OrderedDict, namedtuple
+except ImportError:
+    OrderedDict = namedtuple = None
+try:
+    from psycopg2.extensions import get_wait_callback
+except ImportError:
+    get_wait_callback = None
+
+def copy_value(value, encoding):
+    """Text representation of value for COPY ... FROM STDIN.
+    Raises ValueError for types that have to go through query parameters."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, (int, long, Decimal)):
+        value = str(value)
+    elif isinstance(value, (datetime, date, time)):
+        value = value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode(encoding)
+    elif not isinstance(value, str):
+        raise ValueError("Can't copy value %s" % repr(value))
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+named_param_re = re.compile(r'%\((\w+)\)s')
+
+def to_positional(sql):
+    """Convert pyformat sql to a statement with $n parameters.
+    Returns the statement and parameter names in $n order."""
+    names = []
+    def repl(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return '$%d' % (names.index(name) + 1)
+    return named_param_re.sub(repl, sql).replace('%%', '%'), names
+
+class StatementCache(object):
+    """LRU of server-side prepared statements of one connection.
+    DataSets sharing a connection should share its cache."""
+    def __init__(self, size=100):
+        self.size = size
+        self.statements = OrderedDict()
+        self.counter = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key):
+        entry = self.statements.pop(key, None)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.statements[key] = entry
+        return entry
+    def add(self, key, param_names):
+        """Register a new statement. Returns the entry and names of evicted statements"""
+        self.counter += 1
+        entry = ('pyorm_stmt_%d' % self.counter, param_names)
+        self.statements[key] = entry
+        evicted = []
+        while len(self.statements) > self.size:
+            old_key, (name, names) = self.statements.popitem(last=False)
+            evicted.append(name)
+            self.evictions += 1
+        return entry, evicted
+    def discard(self, key):
+        """Forget a statement whose prepare failed"""
+        self.statements.pop(key, None)
+    def drop_schema(self, schema):
+        """Forget statements prepared for schema. Returns their names"""
+        keys = [key for key in self.statements if key[0] == schema]
+        return [self.statements.pop(key)[0] for key in keys]
+    def clear(self):
+        names = [name for name, param_names in self.statements.itervalues()]
+        self.statements.clear()
+        return names
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self.statements))
+
+class StatementPipeline(Pipeline):
+    """Queues single-row statements and runs them in one round trip.
+
+    psycopg2 returns only the last result set of a multi-statement execute,
+    so queued statements are combined into one select, each one left joined
+    as a subquery returning at most one row.
+    """
+    def __init__(self, ds):
+        Pipeline.__init__(self, ds)
+        self.items = []
+    def add(self, sql, params, column_count, convert):
+        """Queue sql returning at most one row of column_count columns.
+        convert(row) gives the future's value, row is None if nothing was found"""
+        future = Future()
+        self.items.append((sql, params, column_count, convert, future))
+        return future
+    def run(self):
+        items, self.items = self.items, []
+        if not items:
+            return
+        sql = ['select * from (select 1) q']
+        params = {}
+        for i, (item_sql, item_params, column_count, convert, future) in enumerate(items):
+            prefix = 'p%d_' % i
+            sql.append('left join (%s) q%d on true' % (
+                named_param_re.sub(lambda m: '%%(%s%s)s' % (prefix, m.group(1)), item_sql), i))
+            for name, value in item_params.iteritems():
+                params[prefix + name] = value
+        row = self.ds.execute('\n'.join(sql), params).fetchone()
+        pos = 1
+        for item_sql, item_params, column_count, convert, future in items:
+            future.set(convert(row[pos:pos+column_count]))
+            pos += column_count
 
 class QueryIterator(object):
-    def __init__(self, query, cur):
+    """Pulls rows from the cursor batch_size at a time and builds models
+    for a whole batch at once"""
+    def __init__(self, query, cur, batch_size=100):
         self.query = query
         self.cur = cur
+        self.batch_size = batch_size
+        self.batch = []
+        self.load = query.make_loader()
     def __iter__(self):
         return self
     def next(self):
-        rec = self.cur.fetchone()
-        if rec is None:
-            raise StopIteration
-        res = self.query.model(self.query.session, **dict(zip(self.query.props, rec)))
-        res.saved = True
-        return res
+        if not self.batch:
+            if self.cur is None:
+                raise StopIteration
+            rows = self.cur.fetchmany(self.batch_size)
+            if not rows:
+                self.cur.close()
+                self.cur = None
+                raise StopIteration
+            self.batch = map(self.load, rows)
+            self.batch.reverse()
+        return self.batch.pop()
 
 class Query(object):
     def __init__(self, model_class, session, props):
@@ -23,12 +158,15 @@ class Query(object):
         self.params = {}
         self.par_id = 1
         self._order = ''
+        # [(prop, descending)] of order(), None after raw_order
+        self._order_props = []
+        self._group_by = []
         if props:
             self.props = props.split(',')
         elif model_class._default_props:
             self.props = model_class._default_props
         else:
-            self.props = [p for p in model_class._properties.keys() if not model_class._properties[p].virtual]
+            self.props = model_class._meta.props
     def filter(self, *args, **kwargs):
         if args:
             assert len(args)==2, "filter method require exactly 2 positional parameters"
@@ -51,7 +189,7 @@ class Query(object):
             prop_name, op = arr
         else:
             raise FilterError("Wrong filter prop: %s" % repr(prop))
-        fld = self.model._properties[prop_name].fieldname
+        fld = self.model._meta.fieldnames[prop_name]
         if value is None:
             if op == '=':
                 op = 'is null'
@@ -65,25 +203,77 @@ class Query(object):
             self.par_id += 1
             self.params[par_name] = value
             self.conditions.append("%s %s %%(%s)s" % (fld, op, par_name))
-    def get_sql(self, limit=None, offset=None, head=None, ignore_order=False):
-        m = self.model
-        fields = ', '.join([m._properties[p].fieldname for p in self.props])
-        sql = [head or 'select ' + fields]
+    def get_sql(self, limit=None, offset=None, head=None, ignore_order=False, props=None):
+        sql = [head or 'select ' + self.model._meta.field_list(props or self.props)]
         sql.append(self._from)
         if self.conditions:
             sql.append( 'where %s' % ' and '.join(self.conditions))
         if self._order and not ignore_order:
             sql.append( 'order by %s' % (', '.join(self._order)))
         if limit:
-            sql.append('limit %d' % limit)
+            sql.append('limit %(pyorm_limit)s')
         if offset:
-            sql.append('offset %d' % offset)
+            sql.append('offset %(pyorm_offset)s')
         return '\n'.join(sql)
+    def limit_params(self, limit=None, offset=None):
+        """Query parameters plus those of get_sql(limit, offset). Limits are
+        parameters so that one prepared statement serves every page."""
+        params = dict(self.params)
+        if limit:
+            params['pyorm_limit'] = limit
+        if offset:
+            params['pyorm_offset'] = offset
+        return params
+    def make_loader(self):
+        """Function building a saved model instance from a result row"""
+        return partial(self.model._meta.loader(self.props), self.session)
+    def execute(self, sql, params, operation='query'):
+        return self.session.execute_prepared(sql, lambda: sql, params, (self.model, operation))
     def __iter__(self):
-        return QueryIterator(self, self.session.execute(self.get_sql(), self.params))
+        return QueryIterator(self, self.execute(self.get_sql(), self.params))
+    def iter_rows(self, props, batch_size=1000):
+        cur = self.execute(self.get_sql(props=props), self.params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    def tuples(self, named=False):
+        """Iterate over rows as tuples in Query.props order, or as namedtuples.
+        No models are built: a row costs the tuple the cursor returns anyway,
+        instead of a model instance plus its data and kwargs dicts."""
+        if named:
+            row_cls = namedtuple('Row', self.props)
+            return imap(row_cls._make, self.iter_rows(self.props))
+        return self.iter_rows(self.props)
+    def values(self, *props):
+        """Iterate over rows as dicts of props (Query.props by default)"""
+        props = list(props) or self.props
+        return (dict(zip(props, row)) for row in self.iter_rows(props))
+    def scalar_list(self, prop):
+        """List of values of one property"""
+        return [row[0] for row in self.iter_rows([prop])]
+    def stream(self, batch_size=1000):
+        """Iterate over a server-side cursor, keeping at most batch_size rows
+        in client memory. Must be consumed inside the current transaction."""
+        cur = self.session.execute(self.get_sql(), self.params, cursor_name=self.session.new_cursor_name(),
+                op=(self.model, 'stream'))
+        return QueryIterator(self, cur, batch_size)
     def fetch(self, limit, offset=0):
-        return list(QueryIterator(self, self.session.execute(self.get_sql(limit=limit, offset=offset), self.params)))
+        return list(QueryIterator(self, self.execute(self.get_sql(limit=limit, offset=offset),
+                self.limit_params(limit, offset))))
     def fetchone(self):
+        pipe = self.session.pipe
+        if pipe is not None:
+            fields = self.model._meta.field_list(self.props)
+            load = self.make_loader()
+            def convert(row):
+                if row[0] is None:
+                    return None
+                return load(row[1:])
+            return pipe.add(self.get_sql(limit=1, head='select true, ' + fields), self.limit_params(1),
+                    len(self.props) + 1, convert)
         res = self.fetch(limit=1)
         if res:
             return res[0]
@@ -91,106 +281,424 @@ class Query(object):
             return None
     def order(self, fields):
         self._order = []
+        self._order_props = []
         for prop_name in  [f.strip() for f in fields.split(',')]:
             desc = ''
             if prop_name[0]=='-':
                 desc = ' desc'
                 prop_name = prop_name[1:]
-            self._order.append('%s%s' % (self.model._properties[prop_name].fieldname, desc))
+            self._order.append('%s%s' % (self.model._meta.fieldnames[prop_name], desc))
+            self._order_props.append((prop_name, bool(desc)))
         return self
     def raw_order(self, fields):
         self._order = [fields]
+        self._order_props = None
         return self
+    def page(self, limit, after=None):
+        """Models of the page following the row of token after (the first page
+        if None) and the token of the page last row, None on the last page.
+        Rows are ordered by the order() props and then by the primary key, and
+        found with a where condition on those values instead of an offset,
+        so the order props must not be null."""
+        if self._order_props is None:
+            raise ORMError("page doesn't work with raw_order")
+        fieldnames = self.model._meta.fieldnames
+        keyset = list(self._order_props)
+        ordered = [p for p, desc in keyset]
+        keyset.extend([(p, False) for p in self.model._meta.key if p not in ordered])
+        conditions = list(self.conditions)
+        params = dict(self.params)
+        if after is not None:
+            values = decode_token(after)
+            if len(values) != len(keyset):
+                raise ORMError("Wrong page token: %r" % after)
+            for i, value in enumerate(values):
+                params['seek%d' % i] = value
+            if len(set([desc for p, desc in keyset])) == 1:
+                conditions.append('(%s) %s (%s)' % (', '.join([fieldnames[p] for p, desc in keyset]),
+                        keyset[0][1] and '<' or '>',
+                        ', '.join(['%%(seek%d)s' % i for i in range(len(keyset))])))
+            else:
+                # mixed directions: a > x or (a = x and b < y) or ...
+                alternatives = []
+                for i, (p, desc) in enumerate(keyset):
+                    cond = ['%s = %%(seek%d)s' % (fieldnames[q], j) for j, (q, d) in enumerate(keyset[:i])]
+                    cond.append('%s %s %%(seek%d)s' % (fieldnames[p], desc and '<' or '>', i))
+                    alternatives.append('(%s)' % ' and '.join(cond))
+                conditions.append('(%s)' % ' or '.join(alternatives))
+        # keyset props missing from the projection are selected after it
+        columns = list(self.props) + [p for p, desc in keyset if p not in self.props]
+        sql = ['select ' + self.model._meta.field_list(columns), self._from]
+        if conditions:
+            sql.append('where %s' % ' and '.join(conditions))
+        sql.append('order by %s' % ', '.join(['%s%s' % (fieldnames[p], desc and ' desc' or '') for p, desc in keyset]))
+        sql.append('limit %(pyorm_limit)s')
+        params['pyorm_limit'] = limit + 1
+        rows = self.execute('\n'.join(sql), params, 'page').fetchall()
+        models = map(self.make_loader(), rows[:limit])
+        token = None
+        if len(rows) > limit:
+            token = encode_token([rows[limit - 1][columns.index(p)] for p, desc in keyset])
+        return models, token
     def count(self):
-        return self.session.execute(self.get_sql(head = 'select count(1)', ignore_order=True), self.params).fetchone()[0]
+        pipe = self.session.pipe
+        if pipe is not None:
+            return pipe.add(self.get_sql(head = 'select count(1)', ignore_order=True), self.params,
+                    1, lambda row: row[0])
+        return self.execute(self.get_sql(head = 'select count(1)', ignore_order=True), self.params, 'count').fetchone()[0]
+    def group_by(self, *props):
+        self._group_by = list(props)
+        return self
+    def aggregate(self, **aggregates):
+        """Aggregates given as name=Sum('prop') computed in one statement. Returns
+        a dict of them, or with group_by a list of dicts which also hold the
+        group props, ordered by the group props"""
+        names = sorted(aggregates)
+        fieldnames = self.model._meta.fieldnames
+        group_fields = [fieldnames[p] for p in self._group_by]
+        columns = group_fields + [aggregates[name].sql(fieldnames) for name in names]
+        sql = self.get_sql(head='select ' + ', '.join(columns), ignore_order=True)
+        if not group_fields:
+            return dict(zip(names, self.execute(sql, self.params, 'aggregate').fetchone()))
+        sql += '\ngroup by %s\norder by %s' % (', '.join(group_fields), ', '.join(group_fields))
+        keys = self._group_by + names
+        return [dict(zip(keys, row)) for row in self.execute(sql, self.params, 'aggregate').fetchall()]
     def delete(self):
-        self.session.execute(self.get_sql(head = 'delete', ignore_order=True), self.params)
+        self.session.flush()
+        self.execute(self.get_sql(head = 'delete', ignore_order=True), self.params, 'delete')
+        self.session.table_changed(self.model)
     def update(self, param_dict):
+        self.session.flush()
         prop_list = param_dict.keys()
         m = self.model
         params = {}
         fields = []
+        def param(value):
+            param_name = 'par_%d' % len(params)
+            params[param_name] = value
+            return '%%(%s)s' % param_name
         for p in prop_list:
-            param_name = 'par_' + p
-            fields.append("%s=%%(%s)s" % (m._properties[p].fieldname, param_name))
-            params[param_name] = param_dict[p]
+            value = param_dict[p]
+            if isinstance(value, Expression):
+                # computed from the row, e.g. F('priority') + 1
+                fields.append("%s=%s" % (m._meta.fieldnames[p], value.sql(m._meta.fieldnames, param)))
+            else:
+                param_name = 'par_' + p
+                fields.append("%s=%%(%s)s" % (m._meta.fieldnames[p], param_name))
+                params[param_name] = value
         sql = ['update %s set\n' % m._table_name]
         sql.append(','.join(fields))
         if self.conditions:
             sql.append( 'where %s' % ' and '.join(self.conditions))
         params.update(self.params)
-        self.session.execute('\n'.join(sql), params)
+        self.execute('\n'.join(sql), params, 'update')
+        self.session.table_changed(self.model)
 
 class DataSet(object):
-    def __init__(self, con, schema=''):
+    # encoding of unicode values sent through COPY, must match the client encoding
+    copy_encoding = 'utf8'
+    def __init__(self, con, schema='', statements=None):
+        """statements: StatementCache of the connection. If given, get, save,
+        delete and queries run as prepared statements"""
         self.con = con
         self.schema = schema
-    def cursor(self):
+        self.statements = statements
+        self.cursor_id = 0
+        # UnitOfWork in deferred mode
+        self.pending = None
+        # instrument.Observer instances
+        self.observers = []
+        # active StatementPipeline
+        self.pipe = None
+    def cursor(self, name=None):
+        if name:
+            return self.con.cursor(name)
         return self.con.cursor()
+    def new_cursor_name(self):
+        self.cursor_id += 1
+        return 'pyorm_cursor_%d' % self.cursor_id
     def build_pk_cond(self, model_cls, key_dict, params):
-        cond = []
-        for prop in model_cls._key.split(','):
-            field_name = model_cls._properties[prop].fieldname
-            params['pk_'+field_name] = key_dict[prop]
-            cond.append(field_name+'=%%(pk_%s)s' % field_name)
-        return ' and '.join(cond)
+        meta = model_cls._meta
+        params.update(meta.key_params(key_dict.get))
+        return meta.pk_cond
     def get(self, model_cls, key):
-        prop_list = [p for p in model_cls._properties.keys() if not model_cls._properties[p].virtual]
-        fields = ', '.join([model_cls._properties[p].fieldname for p in prop_list])
-        params = {}
+        meta = model_cls._meta
         if not isinstance(key, tuple):
             key = (key,)
-        key_dict = dict(zip(model_cls._key.split(','),key))
-        sql = 'select %s from %s where %s' %(fields, model_cls._table_name, self.build_pk_cond(model_cls, key_dict, params))
-        rec = self.execute(sql, params).fetchone()
+        params = meta.key_params(dict(zip(meta.key, key)).get)
+        load = meta.loader()
+        if self.pipe is not None:
+            def convert(row):
+                if row[0] is None:
+                    return None
+                return load(self, row[1:])
+            return self.pipe.add(meta.get_sql.replace('select ', 'select true, ', 1), params,
+                    len(meta.props) + 1, convert)
+        rec = self.execute_prepared((model_cls, 'get'), lambda: meta.get_sql, params).fetchone()
         if rec:
-            res = model_cls(self, **dict(zip(prop_list, rec)))
-            res.saved = True
+            return load(self, rec)
+        return None
+    def get_many(self, model_cls, keys, chunk_size=1000):
+        """Models for keys in the same order, None for missing ones. Single
+        column keys are looked up with 'in', composite keys by joining a
+        values list, chunk_size keys per statement."""
+        meta = model_cls._meta
+        load = meta.loader()
+        fields = ', '.join(['t.' + f for f in meta.fields])
+        key_props = meta.key
+        key_fields = meta.key_fields
+        key_pos = [meta.props.index(p) for p in key_props]
+        keys = list(keys)
+        if len(key_props) == 1:
+            for i, key in enumerate(keys):
+                if isinstance(key, tuple):
+                    keys[i] = key[0]
+            sql = 'select %s from %s t where t.%s in %%(keys)s' % (fields, model_cls._table_name, key_fields[0])
         else:
-            res = None
-        return res
+            row_sql = '(%s)' % ', '.join(['%s'] * len(key_props))
+            on = ' and '.join(['t.%s = k.%s' % (f, f) for f in key_fields])
+        unique = []
+        seen = set()
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                unique.append(key)
+        found = {}
+        for start in xrange(0, len(unique), chunk_size):
+            chunk = unique[start:start+chunk_size]
+            if len(key_props) == 1:
+                cur = self.execute(sql, {'keys': tuple(chunk)}, op=(model_cls, 'get_many'))
+            else:
+                params = []
+                for key in chunk:
+                    params.extend(key)
+                cur = self.execute('select %s from %s t join (values %s) as k(%s) on %s' % (fields,
+                        model_cls._table_name, ', '.join([row_sql] * len(chunk)), ', '.join(key_fields), on), params,
+                        op=(model_cls, 'get_many'))
+            for rec in cur.fetchall():
+                res = load(self, rec)
+                if len(key_pos) == 1:
+                    found[rec[key_pos[0]]] = res
+                else:
+                    found[tuple([rec[i] for i in key_pos])] = res
+        return [found.get(key) for key in keys]
     def save(self, model):
-        prop_list = [p for p in model._properties.keys() if not model._properties[p].virtual]
+        if self.pending is not None:
+            self.pending.save(model)
+            return
         if model.saved:
             # object already exist in db. update
             if model.changed:
                 # object properties modified
-                sql = ["update %s set" % model._table_name]
-                upd_fields = []
-                params = {}
-                for prop_name in prop_list:
-                    if model.data.get(prop_name) != model.old.get(prop_name):
-                        upd_fields.append("%s=%%(%s)s" % (model._properties[prop_name].fieldname, prop_name))
-                        params[prop_name] = model[prop_name]
-                if upd_fields:
-                    sql.append(",\n".join(upd_fields))
-                    sql.append("where")
-                    sql.append(self.build_pk_cond(model, model.old, params))
-                    self.execute('\n'.join(sql), params)
+                changed = model.changed_props()
+                if changed:
+                    meta = model._meta
+                    params = meta.key_params(model.original)
+                    for p in changed:
+                        params[p] = model[p]
+                    self.execute_prepared((type(model), 'update', tuple(changed)),
+                            lambda: meta.update_sql(changed), params)
                 del model.old
         else:
             # new object. insert
-            fields = [model._properties[name].fieldname for name in prop_list]
-            params = dict([(name, model[name]) for name in prop_list])
-            sql = "insert into %s (%s)\n  values (%s)" % (model._table_name,
-                    ','.join(fields),
-                    ','.join(['%%(%s)s' % name for name in prop_list]))
-            self.execute(sql, params)
-    def delete(self, model):
-        params = {}
-        sql = "delete from %s where %s" % (model._table_name, self.build_pk_cond(model, model.data, params))
+            meta = model._meta
+            params = dict([(name, model[name]) for name in meta.props])
+            self.execute_prepared((type(model), 'insert'), lambda: meta.insert_sql, params)
+    def save_many(self, models, chunk_size=1000, copy=True):
+        """Save a batch of models. New models are inserted with COPY FROM STDIN,
+        or with multi-row inserts if copy is False or a value can't be copied,
+        chunk_size rows at a time. Already saved models are updated one by one."""
+        for model in models:
+            model.before_save()
+        if self.pending is not None:
+            for model in models:
+                self.pending.save(model)
+                model.saved = True
+            return
+        for model_cls, group in group_by_class(models):
+            new = []
+            for model in group:
+                if model.saved:
+                    self.save(model)
+                else:
+                    new.append(model)
+            self.insert_many(model_cls, new, chunk_size, copy)
+            for model in new:
+                model.saved = True
+    def insert_many(self, model_cls, models, chunk_size=1000, copy=True):
+        prop_list = model_cls._meta.props
+        fields = model_cls._meta.fields
+        for start in xrange(0, len(models), chunk_size):
+            rows = [[model[name] for name in prop_list] for model in models[start:start+chunk_size]]
+            if not (copy and self.copy_rows(model_cls._table_name, fields, rows)):
+                self.insert_rows(model_cls._table_name, fields, rows)
+    def update_many(self, model_cls, changed, models, chunk_size=500):
+        """Update models which have the same changed props, sending chunk_size
+        update statements in one round trip"""
+        fieldnames = model_cls._meta.fieldnames
+        key_props = model_cls._meta.key
+        for start in xrange(0, len(models), chunk_size):
+            statements = []
+            params = {}
+            for i, model in enumerate(models[start:start+chunk_size]):
+                fields = []
+                for p in changed:
+                    params['u%d_%s' % (i, p)] = model[p]
+                    fields.append('%s=%%(u%d_%s)s' % (fieldnames[p], i, p))
+                cond = []
+                for p in key_props:
+                    params['u%d_pk_%s' % (i, p)] = model.original(p)
+                    cond.append('%s=%%(u%d_pk_%s)s' % (fieldnames[p], i, p))
+                statements.append('update %s set %s where %s' % (model_cls._table_name,
+                        ', '.join(fields), ' and '.join(cond)))
+            self.execute(';\n'.join(statements), params, op=(model_cls, 'update_many'))
+    def delete_many(self, model_cls, models, chunk_size=1000):
+        key_props = model_cls._meta.key
+        fields = model_cls._meta.key_fields
+        if len(key_props) == 1:
+            cond = '%s in %%(keys)s' % fields[0]
+        else:
+            cond = '(%s) in %%(keys)s' % ', '.join(fields)
+        sql = 'delete from %s where %s' % (model_cls._table_name, cond)
+        for start in xrange(0, len(models), chunk_size):
+            chunk = models[start:start+chunk_size]
+            if len(key_props) == 1:
+                keys = tuple([model.data[key_props[0]] for model in chunk])
+            else:
+                keys = tuple([tuple([model.data[p] for p in key_props]) for model in chunk])
+            self.execute(sql, {'keys': keys}, op=(model_cls, 'delete_many'))
+    def copy_rows(self, table_name, fields, rows):
+        """Insert rows with COPY FROM STDIN. Returns False if the rows can't be
+        copied, or if a wait callback (async_pg_datasource) forbids COPY"""
+        if get_wait_callback is not None and get_wait_callback() is not None:
+            return False
+        try:
+            lines = ['\t'.join([copy_value(v, self.copy_encoding) for v in row]) for row in rows]
+        except ValueError:
+            return False
+        cur = self.cursor()
+        if not hasattr(cur, 'copy_expert'):
+            return False
+        sql = "copy %s (%s) from stdin" % (table_name, ','.join(fields))
+        cur.copy_expert(self.fix_sql(sql), StringIO('\n'.join(lines) + '\n'))
+        return True
+    def insert_rows(self, table_name, fields, rows):
+        row_sql = '(%s)' % ','.join(['%s'] * len(fields))
+        sql = "insert into %s (%s)\n  values %s" % (table_name,
+                ','.join(fields),
+                ',\n    '.join([row_sql] * len(rows)))
+        params = []
+        for row in rows:
+            params.extend(row)
         self.execute(sql, params)
+    def delete(self, model):
+        if self.pending is not None:
+            self.pending.delete(model)
+            return
+        meta = model._meta
+        self.execute_prepared((type(model), 'delete'), lambda: meta.delete_sql,
+                meta.key_params(model.data.get))
+    query_class = Query
     def query(self, model_class, props):
-        return Query(model_class, self, props)
+        return self.query_class(model_class, self, props)
+    def table_changed(self, model_cls):
+        """Called after rows of model_cls were changed in bulk by a Query"""
+        pass
+    def pipeline(self):
+        """Context in which get, count and fetchone return Futures, all sent
+        to the server in one statement when the context exits"""
+        return StatementPipeline(self)
     def fix_sql(self, sql):
         schema = self.schema
         if schema:
             schema=schema+'.'
         return sql.replace('$(schema).', schema)
-    def execute(self, sql, params=None):
+    def execute(self, sql, params=None, cursor_name=None, op=None):
+        """op: (model class, operation name) reported to observers"""
+        cur = self.cursor(cursor_name)
+        sql = self.fix_sql(sql)
+        if self.observers:
+            observe(self, op, sql, params, cur.execute, (sql, params), lambda res: cur.rowcount)
+        else:
+            cur.execute(sql, params)
+        return cur
+    def execute_prepared(self, key, build, params, op=None):
+        """Execute the statement returned by build() as a prepared statement.
+        key identifies the statement shape; build is only called on a cache miss.
+        Statements with list parameters (in filters) are executed directly.
+        op defaults to key[:2] for (model class, operation, ...) keys."""
+        if op is None and isinstance(key, tuple):
+            op = key[:2]
+        if self.statements is None or [v for v in params.itervalues() if isinstance(v, (list, tuple))]:
+            return self.execute(build(), params, op=op)
+        cache_key = (self.schema, key)
+        entry = self.statements.get(cache_key)
+        if entry is None:
+            sql, param_names = to_positional(self.fix_sql(build()))
+            entry, evicted = self.statements.add(cache_key, param_names)
+            cur = self.cursor()
+            try:
+                for name in evicted:
+                    cur.execute('deallocate %s' % name)
+                cur.execute('prepare %s as %s' % (entry[0], sql))
+            except Exception:
+                # the server has no such statement, don't hit it later
+                self.statements.discard(cache_key)
+                raise
+        name, param_names = entry
         cur = self.cursor()
-        cur.execute(self.fix_sql(sql), params)
+        sql = 'execute %s' % name
+        values = None
+        if param_names:
+            sql = 'execute %s (%s)' % (name, ', '.join(['%s'] * len(param_names)))
+            values = [params[p] for p in param_names]
+        if self.observers:
+            observe(self, op, self.fix_sql(build()), params, cur.execute, (sql, values), lambda res: cur.rowcount)
+        else:
+            cur.execute(sql, values)
         return cur
+    def set_schema(self, schema):
+        """Switch tenant schema, deallocating statements prepared for the old one"""
+        if self.statements is not None and schema != self.schema:
+            cur = self.cursor()
+            for name in self.statements.drop_schema(self.schema):
+                cur.execute('deallocate %s' % name)
+        self.schema = schema
+    def defer(self, enabled=True):
+        """Switch deferred mode. In deferred mode save and delete only register
+        models, which are written in batches by flush or commit."""
+        if enabled:
+            if self.pending is None:
+                self.pending = UnitOfWork()
+        else:
+            self.flush()
+            self.pending = None
+    def flush(self):
+        """Write models registered in deferred mode: inserts grouped by class,
+        updates grouped by class and changed columns, then deletes in reverse
+        order of class registration"""
+        uow = self.pending
+        if not uow:
+            return
+        self.pending = UnitOfWork()
+        for model_cls, group in group_by_class(uow.new):
+            self.insert_many(model_cls, group)
+            for model in group:
+                if hasattr(model, 'old'):
+                    del model.old
+        for (model_cls, changed), group in uow.changed_groups():
+            self.update_many(model_cls, changed, group)
+            for model in group:
+                del model.old
+        groups = group_by_class(uow.deleted)
+        groups.reverse()
+        for model_cls, group in groups:
+            self.delete_many(model_cls, group)
     def commit(self):
+        self.flush()
         self.con.commit()
+    def rollback(self):
+        if self.pending is not None:
+            self.pending = UnitOfWork()
+        self.con.rollback()
 
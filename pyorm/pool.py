@@ -0,0 +1,248 @@
+"""Thread-safe connection pool and pooled DataSet views for pg_datasource.
+
+    pool = ConnectionPool(lambda: psycopg2.connect(dsn), min_size=2, max_size=20)
+    with pool.dataset('tenant1') as ds:
+        user = User.get(ds, 'John')
+        user.email = 'john@example.com'
+        user.save()
+        ds.commit()
+
+A view checks a connection out on its first statement and back in when the
+with block exits or on close(). Idle connections last used by the same
+schema are preferred, so statements prepared for a tenant are reused. With
+statements_size set, every connection has its own StatementCache. Checked
+in connections are rolled back and cleaned with reset_sql; broken ones are
+replaced.
+"""
+
+import time
+import threading
+from model import ORMError, UnitOfWork
+from pg_datasource import DataSet, StatementCache
+
+class PoolTimeout(ORMError): pass
+
+class PooledConnection(object):
+    __slots__ = ('con', 'schema', 'statements', 'last_used', 'last_checked')
+    def __init__(self, con, statements, now):
+        self.con = con
+        self.schema = None
+        self.statements = statements
+        self.last_used = now
+        self.last_checked = now
+
+class PooledDataSet(DataSet):
+    """Short-lived DataSet view of (pool, schema)"""
+    def __init__(self, pool, schema=''):
+        DataSet.__init__(self, None, schema)
+        self.pool = pool
+        self.entry = None
+    def checkout(self):
+        if self.entry is None:
+            self.entry = self.pool.checkout(self.schema)
+            self.con = self.entry.con
+            self.statements = self.entry.statements
+    def cursor(self, name=None):
+        self.checkout()
+        return DataSet.cursor(self, name)
+    def execute_prepared(self, key, build, params, op=None):
+        # the statement cache comes with the connection
+        self.checkout()
+        return DataSet.execute_prepared(self, key, build, params, op)
+    def commit(self):
+        self.flush()
+        if self.con is not None:
+            self.con.commit()
+    def rollback(self):
+        if self.pending is not None:
+            self.pending = UnitOfWork()
+        if self.con is not None:
+            self.con.rollback()
+    def close(self):
+        """Return the connection to the pool, uncommitted changes are rolled back"""
+        if self.entry is not None:
+            entry, self.entry = self.entry, None
+            self.con = self.statements = None
+            self.pool.checkin(entry)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class ConnectionPool(object):
+    """Pool of min_size to max_size connections made by connect().
+    checkout waits up to timeout seconds for a free connection, then raises
+    PoolTimeout. Connections idle longer than check_interval seconds are
+    checked with check_sql before reuse, connections idle longer than
+    idle_timeout are closed down to min_size. clock measures idle times.
+
+    reset_sql is committed on checkin after the rollback, so session settings,
+    temporary tables and advisory locks of one view don't leak into the
+    next. DISCARD ALL is avoided, it would also deallocate the prepared
+    statements of the StatementCache. None disables the reset."""
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30, idle_timeout=600,
+                 check_interval=30, check_sql='select 1', statements_size=None, clock=time.time,
+                 reset_sql='RESET ALL; DISCARD TEMP; SELECT pg_advisory_unlock_all()'):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.check_sql = check_sql
+        self.reset_sql = reset_sql
+        self.statements_size = statements_size
+        self.clock = clock
+        self.lock = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        while self.size < min_size:
+            self.size += 1
+            self.idle.append(self.new_entry(connect()))
+    def new_entry(self, con):
+        """PooledConnection of a new connection, counted in size by the caller"""
+        statements = None
+        if self.statements_size:
+            statements = StatementCache(self.statements_size)
+        self.created += 1
+        return PooledConnection(con, statements, self.clock())
+    def discard(self, entry):
+        self.size -= 1
+        self.discarded += 1
+        try:
+            entry.con.close()
+        except Exception:
+            pass
+    def healthy(self, entry):
+        """Run check_sql on the connection, called without holding the lock"""
+        try:
+            cur = entry.con.cursor()
+            cur.execute(self.check_sql)
+            entry.con.rollback()
+        except Exception:
+            return False
+        entry.last_checked = self.clock()
+        return True
+    def take_idle(self, schema):
+        """Idle connection last used by schema, or the most recently used one"""
+        for i in xrange(len(self.idle) - 1, -1, -1):
+            if self.idle[i].schema == schema:
+                return self.idle.pop(i)
+        return self.idle.pop()
+    def prune(self):
+        now = self.clock()
+        while self.size > self.min_size and self.idle and now - self.idle[0].last_used > self.idle_timeout:
+            self.discard(self.idle.pop(0))
+    def checkout(self, schema=None, timeout=None):
+        """PooledConnection for schema, waiting for a free one if the pool is full"""
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        self.lock.acquire()
+        try:
+            waited = False
+            while True:
+                entry = None
+                while self.idle:
+                    candidate = self.take_idle(schema)
+                    if getattr(candidate.con, 'closed', False):
+                        self.discard(candidate)
+                        continue
+                    if self.clock() - candidate.last_checked >= self.check_interval:
+                        # the candidate is out of idle, check it outside of the lock
+                        self.lock.release()
+                        try:
+                            ok = self.healthy(candidate)
+                        finally:
+                            self.lock.acquire()
+                        if not ok:
+                            self.discard(candidate)
+                            continue
+                    entry = candidate
+                    break
+                if entry is None and self.size < self.max_size:
+                    # reserve the slot and connect outside of the lock
+                    self.size += 1
+                    self.lock.release()
+                    try:
+                        con = self.connect()
+                    except:
+                        self.lock.acquire()
+                        self.size -= 1
+                        raise
+                    self.lock.acquire()
+                    entry = self.new_entry(con)
+                if entry is not None:
+                    break
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("No free connection in %s seconds" % timeout)
+                waited = True
+                self.lock.wait(remaining)
+            wait = time.time() - start
+            if waited:
+                self.waits += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            entry.schema = schema
+            return entry
+        finally:
+            self.lock.release()
+    def checkin(self, entry):
+        """Roll back, reset and return a connection, broken ones are closed"""
+        try:
+            entry.con.rollback()
+            if self.reset_sql:
+                # SET and RESET are undone by a rollback, commit the reset
+                cur = entry.con.cursor()
+                cur.execute(self.reset_sql)
+                entry.con.commit()
+            broken = getattr(entry.con, 'closed', False)
+        except Exception:
+            broken = True
+        self.lock.acquire()
+        try:
+            self.in_use -= 1
+            if broken:
+                self.discard(entry)
+            else:
+                entry.last_used = self.clock()
+                self.idle.append(entry)
+                self.prune()
+            self.lock.notify()
+        finally:
+            self.lock.release()
+    def dataset(self, schema=''):
+        """PooledDataSet view bound to schema"""
+        return PooledDataSet(self, schema)
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict(size=self.size, idle=len(self.idle), in_use=self.in_use, peak_in_use=self.peak_in_use,
+                        utilisation=float(self.in_use) / self.max_size, checkouts=self.checkouts,
+                        waits=self.waits, wait_time=self.wait_time, max_wait=self.max_wait,
+                        mean_wait=self.checkouts and self.wait_time / self.checkouts or 0.0,
+                        timeouts=self.timeouts, created=self.created, discarded=self.discarded)
+        finally:
+            self.lock.release()
+    def close(self):
+        """Close the idle connections"""
+        self.lock.acquire()
+        try:
+            while self.idle:
+                self.discard(self.idle.pop())
+        finally:
+            self.lock.release()
@@ -0,0 +1,178 @@
+"""Models spread over several DataSets by a hash of their primary key.
+
+    ds = ShardedDataSet([pg_datasource.DataSet(con1), pg_datasource.DataSet(con2)])
+    ticket = Ticket.get(ds, 42)
+    for ticket in Ticket.query(ds).filter('state', 'Open').order('-date_opened').fetch(20):
+        print ticket.id
+
+get, save and delete go to the shard of the key. Queries run on every
+shard in parallel threads; ordered results are merged and limits are
+pushed down to each shard. Iterating streams the rows of every shard
+through a queue of at most buffer_size models. The shards may be DataSets of any datasource
+(separate databases, schemas of one database, memory DataSets in tests)
+but each must have its own connection. commit and rollback are sent to
+every shard, without two-phase commit.
+"""
+
+import threading
+from zlib import crc32
+from model import ORMError, group_by_class
+from fanout import FanOutQuery, Feed, merge, merge_feeds
+
+def key_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+class ShardedQuery(FanOutQuery):
+    """FanOutQuery over the shards, yielding models bound to the sharded DataSet"""
+    def __iter__(self):
+        for shard, model in self.fanout.stream(self):
+            model.session = self.fanout
+            yield model
+    def fetch(self, limit, offset=0):
+        """Models limit + offset rows are read from every shard"""
+        results = self.fanout.map(self, lambda query: query.fetch(limit + offset))
+        res = []
+        for shard, model in merge(results, self._order_props):
+            if len(res) == limit + offset:
+                break
+            model.session = self.fanout
+            res.append(model)
+        return res[offset:]
+    def fetchone(self):
+        res = self.fetch(limit=1)
+        if res:
+            return res[0]
+        return None
+    def update(self, param_dict):
+        """Update on every shard. Key props can't be assigned, the rows would
+        stay on the shards of their old keys."""
+        assigned = [p for p in self.model._meta.key if p in param_dict]
+        if assigned:
+            raise ORMError("Can't update key props %s of sharded %s" % (', '.join(assigned), self.model.__name__))
+        self.fanout.map(self, lambda query: query.update(param_dict))
+    def delete(self):
+        self.fanout.map(self, lambda query: query.delete())
+
+class ShardedDataSet(object):
+    """Routes models to one of shards by the crc32 of their primary key.
+    Key values are hashed by their str (utf8 for unicode), so an int and a
+    long key land on the same shard."""
+    def __init__(self, shards, buffer_size=1000):
+        self.shards = list(shards)
+        self.buffer_size = buffer_size
+    def shard_index(self, model_cls, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) != len(model_cls._meta.key):
+            raise ORMError("Wrong key %r for %s" % (key, model_cls.__name__))
+        return (crc32('\0'.join([key_bytes(k) for k in key])) & 0xffffffff) % len(self.shards)
+    def shard(self, model_cls, key):
+        return self.shards[self.shard_index(model_cls, key)]
+    def model_key(self, model, get=None):
+        get = get or model.__getitem__
+        return tuple([get(k) for k in model._meta.key])
+    def loaded(self, model):
+        if model is not None:
+            model.session = self
+        return model
+    def get(self, model_cls, key):
+        return self.loaded(self.shard(model_cls, key).get(model_cls, key))
+    def get_many(self, model_cls, keys):
+        keys = list(keys)
+        by_shard = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self.shard_index(model_cls, key), []).append(i)
+        res = [None] * len(keys)
+        for index, positions in by_shard.iteritems():
+            models = self.shards[index].get_many(model_cls, [keys[i] for i in positions])
+            for i, model in zip(positions, models):
+                res[i] = self.loaded(model)
+        return res
+    def save(self, model):
+        ds = self.shard(type(model), self.model_key(model))
+        if model.saved and model.changed:
+            old_ds = self.shard(type(model), self.model_key(model, model.original))
+            if old_ds is not ds:
+                # primary key moved to another shard
+                old = type(model)(old_ds, **dict([(p, model.original(p)) for p in model._meta.props]))
+                old.saved = True
+                old_ds.delete(old)
+                model.saved = False
+                ds.save(model)
+                # the inserted row is the original one from now on
+                if hasattr(model, 'old'):
+                    del model.old
+                return
+        ds.save(model)
+    def save_many(self, models):
+        # before_save may assign the key, run it before routing
+        for model in models:
+            model.before_save()
+        groups = {}
+        for model in models:
+            if model.saved:
+                self.save(model)
+                model.saved = True
+            else:
+                groups.setdefault(self.shard_index(type(model), self.model_key(model)), []).append(model)
+        for index, group in groups.iteritems():
+            ds = self.shards[index]
+            if ds.pending is not None:
+                for model in group:
+                    ds.pending.save(model)
+            else:
+                for model_cls, same in group_by_class(group):
+                    ds.insert_many(model_cls, same)
+            for model in group:
+                model.saved = True
+    def delete(self, model):
+        self.shard(type(model), self.model_key(model)).delete(model)
+    def query(self, model_class, props):
+        return ShardedQuery(model_class, self, props)
+    def use_union(self):
+        return False
+    def map(self, query, fn):
+        """[(shard index, fn(shard Query))] computed by one thread per shard"""
+        results = [None] * len(self.shards)
+        errors = []
+        def work(i, ds):
+            try:
+                results[i] = (i, fn(query.tenant_query(ds)))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(i, ds)) for i, ds in enumerate(self.shards)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+    def stream(self, query):
+        """(shard index, model) pairs in query order, read by one thread per shard"""
+        stop = threading.Event()
+        feeds = [Feed(i, self.buffer_size, stop) for i in range(len(self.shards))]
+        def work(feed, ds):
+            feed.run(lambda: query.tenant_query(ds).stream(self.buffer_size))
+        for feed, ds in zip(feeds, self.shards):
+            thread = threading.Thread(target=work, args=(feed, ds))
+            thread.daemon = True
+            thread.start()
+        return merge_feeds(feeds, stop, query._order_props)
+    def table_changed(self, model_cls):
+        for ds in self.shards:
+            ds.table_changed(model_cls)
+    def defer(self, enabled=True):
+        for ds in self.shards:
+            ds.defer(enabled)
+    def flush(self):
+        for ds in self.shards:
+            ds.flush()
+    def commit(self):
+        for ds in self.shards:
+            ds.commit()
+    def rollback(self):
+        for ds in self.shards:
+            ds.rollback()
@@ -10,6 +10,8 @@ def run_suite(cls):
 
 def run():
     run_suite(test_memory_datasource.AllTests)
+    if hasattr(test_memory_datasource, 'ColumnarTests'):
+        run_suite(test_memory_datasource.ColumnarTests)
     run_suite(test_pg_datasource.AllTests)
 
 run()
@@ -1,10 +1,18 @@
 
 from datetime import datetime
-from pyorm.model import Model, Property
+from pyorm.model import Model, Property, Count, Sum, Min, Max, F
+from pyorm.cache import EntityCache, CachedDataSet
+from pyorm.instrument import QueryStats, NPlusOneDetector
 import unittest
 
 class VerifyError(Exception): pass
 
+class ListLogger(object):
+    def __init__(self):
+        self.messages = []
+    def warning(self, msg, *args):
+        self.messages.append(msg % args)
+
 class User(Model):
     _key = 'username'
     _table_name = '$(schema).user'
@@ -18,6 +26,20 @@ class Agent(User):
     _table_name = '$(schema).agent'
     position = Property()
 
+# same tables, compact storage
+class CompactUser(Model):
+    _compact = True
+    _key = 'username'
+    _table_name = '$(schema).user'
+    username = Property()
+    full_name = Property()
+    email = Property()
+    department = Property(default=u'none')
+
+class CompactAgent(CompactUser):
+    _table_name = '$(schema).agent'
+    position = Property()
+
 class Group(Model):
     _key = 'groupname'
     _table_name = '$(schema).tt_group'
@@ -97,6 +119,18 @@ class BaseTests(unittest.TestCase):
         self.assertEqual(member.username, 'usr1')
         none_member = GroupMember.get(ds, ('usr3', 'gr2'))
         self.assert_(none_member is None)
+    def testGetMany(self):
+        ds = self.dsa
+        users = User.get_many(ds, ['usr3', 'nobody', 'usr1', 'usr3'])
+        self.assertEqual([u and u.username for u in users], ['usr3', None, 'usr1', 'usr3'])
+        self.assertEqual(users[2].email, 'usr1@example.com')
+        members = GroupMember.get_many(ds, [('usr4', 'gr2'), ('usr3', 'gr2'), ('usr3', 'gr1')])
+        self.assertEqual([m and (m.username, m.groupname) for m in members], [('usr4', 'gr2'), None, ('usr3', 'gr1')])
+        self.assertEqual(Ticket.get_many(ds, []), [])
+        cached = CachedDataSet(ds, EntityCache())
+        self.assertEqual([t.id for t in Ticket.get_many(cached, [2, 1])], [2, 1])
+        self.assertEqual([t.id for t in Ticket.get_many(cached, [1, 3])], [1, 3])
+        self.assertEqual(cached.cache.stats()['hits'], 1)
     def testQuery(self):
         ds = self.dsa
         # test order desc
@@ -106,6 +140,71 @@ class BaseTests(unittest.TestCase):
         users = [u.username for u in User.query(ds).filter('department', 'a')]
         users.sort()
         self.assertEqual(users, 'usr1 usr2 usr3'.split())
+    def testFetch(self):
+        ds = self.dsa
+        ids = [t.id for t in Ticket.query(ds).order('-priority,id').fetch(2, 1)]
+        self.assertEqual(ids, [1, 2])
+        ids = [t.id for t in Ticket.query(ds).order('priority,-date_opened')]
+        self.assertEqual(ids, [4, 2, 1, 3])
+        self.assertEqual(Ticket.query(ds).order('id').fetchone().id, 1)
+        self.assert_(Ticket.query(ds).filter('assigned', 'nobody').fetchone() is None)
+    def testStream(self):
+        ds = self.dsa
+        ids = [t.id for t in Ticket.query(ds).order('id').stream(batch_size=3)]
+        self.assertEqual(ids, [1, 2, 3, 4])
+        self.assertEqual(list(Ticket.query(ds).filter('assigned', 'nobody').stream()), [])
+    def testProjection(self):
+        ds = self.dsa
+        query = Ticket.query(ds, 'id,assigned').filter('state', 'Open').order('id')
+        self.assertEqual(list(query.tuples()), [(1, 'usr1'), (2, 'usr1'), (3, 'usr2')])
+        self.assertEqual([row.assigned for row in query.tuples(named=True)], ['usr1', 'usr1', 'usr2'])
+        rows = list(Ticket.query(ds).order('-id').values('id', 'priority'))
+        self.assertEqual(rows[0], {'id': 4, 'priority': 3})
+        self.assertEqual(Ticket.query(ds).filter('assigned', 'usr2').order('id').scalar_list('subject'), ['subj b', 'Subj c'])
+    def testAggregate(self):
+        ds = self.dsa
+        res = Ticket.query(ds).filter('state', 'Open').aggregate(n=Count(), total=Sum('priority'),
+                top=Max('priority'), first=Min('date_opened'))
+        self.assertEqual(res, dict(n=3, total=11, top=5, first=datetime(2011,10,2,12,01)))
+        res = Ticket.query(ds).group_by('assigned').aggregate(n=Count(), total=Sum('priority'))
+        self.assertEqual(res, [dict(assigned=u'usr1', n=2, total=6), dict(assigned=u'usr2', n=2, total=8)])
+        res = Ticket.query(ds).filter('state', 'Spam').aggregate(n=Count('subject'), total=Sum('priority'))
+        self.assertEqual(res, dict(n=0, total=None))
+    def testPage(self):
+        ds = self.dsa
+        pages = []
+        token = None
+        while True:
+            tickets, token = Ticket.query(ds).order('-priority').page(2, after=token)
+            pages.append([t.id for t in tickets])
+            if token is None:
+                break
+        self.assertEqual(pages, [[3, 1], [2, 4]])
+        query = Ticket.query(ds).filter('state', 'Open').order('date_opened')
+        tickets, token = query.page(2)
+        self.assertEqual([t.id for t in tickets], [1, 3])
+        tickets, token = query.page(2, after=token)
+        self.assertEqual(([t.id for t in tickets], token), ([2], None))
+    def testInstrumentation(self):
+        ds = self.dsa
+        logger = ListLogger()
+        stats = QueryStats(slow_threshold=0, logger=logger)
+        detector = NPlusOneDetector(threshold=3, logger=logger)
+        ds.observers.extend([stats, detector])
+        try:
+            with detector:
+                for username in ['usr1', 'usr2', 'usr3']:
+                    User.get(ds, username)
+                Ticket.query(ds).filter('state', 'Open').count()
+        finally:
+            del ds.observers[:]
+        self.assertEqual(detector.warnings, [(User, 3)])
+        # the three gets share a fingerprint
+        self.assertEqual(sorted([entry['count'] for fp, entry in stats.top()]), [1, 3])
+        self.assertEqual(stats.slow, 4)
+        self.assertEqual(len(logger.messages), 5)
+        User.get(ds, 'usr4')
+        self.assertEqual(sum([entry['count'] for fp, entry in stats.top()]), 4)
     def testCount(self):
         ds = self.dsa
         # count must ignore .order()
@@ -133,6 +232,29 @@ class BaseTests(unittest.TestCase):
         self.assert_(cnt == 2)
         self.assert_(Ticket.query(ds).filter('assigned', 'usr2').count() == 4)
         self.assert_(Ticket.get(ds, 2).assigned == 'usr2')
+    def testDirtyTracking(self):
+        ds = self.dsa
+        ticket = Ticket.get(ds, 1)
+        self.assert_(not ticket.changed)
+        ticket.subject = 'changed'
+        ticket.subject = 'changed again'
+        ticket.state = 'Open'
+        self.assert_(ticket.changed)
+        self.assertEqual(ticket.old, {'subject': 'foo', 'state': 'Open'})
+        self.assertEqual(ticket.changed_props(), ['subject'])
+        ticket.cancel()
+        self.assertEqual(ticket.subject, 'foo')
+        self.assert_(not ticket.changed)
+        # assigning a property missing from data restores its default on cancel
+        new = Ticket(ds, id=50, state='Open')
+        new.priority = 1
+        new.cancel()
+        self.assertEqual(new.priority, 3)
+        # primary key change goes through the original key
+        ticket.id = 51
+        ticket.save()
+        self.assert_(Ticket.get(ds, 1) is None)
+        self.assertEqual(Ticket.get(ds, 51).subject, 'foo')
     def testDeleteModel(self):
         ds = self.dsa
         Ticket.get(ds, 2).delete()
@@ -176,6 +298,103 @@ class BaseTests(unittest.TestCase):
         self.assert_(Ticket.get(ds, ticket.id).subject == "unbar276")
         ticket.state = 'Bazz'
         self.assertRaises(VerifyError, ticket.save)
+    def testSaveMany(self):
+        ds = self.dsa
+        tickets = [Ticket(ds, id=20+i, state='Open', subject=u'bulk\t%d\n' % i, assigned=u'usr3') for i in range(5)]
+        tickets.append(Ticket(ds, state='Hold', subject=u'no id', assigned=u'usr3'))
+        Ticket.save_many(ds, tickets)
+        self.assert_(tickets[-1].id is not None)
+        self.assert_(tickets[0].saved)
+        self.assertEqual(Ticket.query(ds).filter('assigned', 'usr3').count(), 6)
+        self.assertEqual(Ticket.get(ds, 22).subject, u'bulk\t2\n')
+        self.assertEqual(Ticket.get(ds, 22).priority, 3)
+        # saved models are updated
+        tickets[0].state = 'Closed'
+        ds.save_many([tickets[0], User(ds, username=u'bulkuser', department=u'c')])
+        self.assertEqual(Ticket.get(ds, 20).state, 'Closed')
+        self.assertEqual(User.get(ds, 'bulkuser').department, 'c')
+        self.assertRaises(VerifyError, ds.save_many, [Ticket(ds, id=40, state='Bazz')])
+    def testDeferred(self):
+        ds = self.dsa
+        ds.defer()
+        for ticket in Ticket.query(ds).filter('assigned', 'usr1'):
+            ticket.assigned = 'usr3'
+            ticket.save()
+        Ticket(ds, id=30, state='Open', assigned='usr3').save()
+        ticket = Ticket(ds, id=31, state='Open')
+        ticket.save()
+        ticket.delete()
+        Ticket.get(ds, 4).delete()
+        GroupMember.get(ds, ('usr1', 'gr2')).delete()
+        # nothing is written before flush
+        self.assertEqual(Ticket.query(ds).filter('assigned', 'usr3').count(), 0)
+        self.assert_(Ticket.get(ds, 4) is not None)
+        ds.flush()
+        self.assertEqual(Ticket.query(ds).filter('assigned', 'usr3').count(), 3)
+        self.assert_(Ticket.get(ds, 31) is None)
+        self.assert_(Ticket.get(ds, 4) is None)
+        self.assert_(GroupMember.get(ds, ('usr1', 'gr2')) is None)
+        user = User.get(ds, 'usr4')
+        user.email = 'deferred@example.com'
+        user.save()
+        ds.commit()
+        self.assertEqual(User.get(ds, 'usr4').email, 'deferred@example.com')
+        # bulk statements see the pending changes
+        Ticket(ds, id=40, state='Spam', assigned='usr4').save()
+        Ticket.query(ds).filter('state', 'Spam').delete()
+        ticket = Ticket.get(ds, 1)
+        ticket.priority = 2
+        ticket.save()
+        Ticket.query(ds).filter('id', 1).update({'priority': F('priority') + 1})
+        ds.commit()
+        self.assert_(Ticket.get(ds, 40) is None)
+        self.assertEqual(Ticket.get(ds, 1).priority, 3)
+        ds.defer(False)
+        self.assert_(ds.pending is None)
+    def testPipeline(self):
+        ds = self.dsa
+        with ds.pipeline():
+            cnt = Ticket.query(ds).filter('assigned', 'usr1').count()
+            user = User.get(ds, 'usr2')
+            missing = User.get(ds, 'nobody')
+            member = GroupMember.get(ds, ('usr4', 'gr2'))
+            first = Ticket.query(ds).order('-id').fetchone()
+        self.assert_(ds.pipe is None)
+        self.assertEqual(cnt.value, 2)
+        self.assertEqual(user.value.email, 'usr2@example.com')
+        self.assert_(missing.value is None)
+        self.assertEqual(member.value.groupname, 'gr2')
+        self.assertEqual(first.value.id, 4)
+    def testEntityCache(self):
+        ds = CachedDataSet(self.dsa, EntityCache(max_entries=2))
+        user = User.get(ds, 'usr1')
+        self.assertEqual(User.get(ds, 'usr1').email, 'usr1@example.com')
+        self.assertEqual(ds.cache.stats()['hits'], 1)
+        user.email = 'cached@example.com'
+        user.save()
+        self.assertEqual(User.get(ds, 'usr1').email, 'cached@example.com')
+        User.query(ds).filter('username', 'usr1').update({'email': 'bulk@example.com'})
+        self.assertEqual(User.get(ds, 'usr1').email, 'bulk@example.com')
+        User.get(ds, 'usr2')
+        User.get(ds, 'usr3')
+        self.assert_(ds.cache.stats()['evictions'] >= 1)
+        self.assertEqual(GroupMember.get(ds, ('usr4', 'gr2')).groupname, 'gr2')
+        GroupMember.get(ds, ('usr4', 'gr2')).delete()
+        self.assert_(GroupMember.get(ds, ('usr4', 'gr2')) is None)
+        # rows of one schema are never served for another
+        key = ds.cache_key(User, 'usr2')
+        self.assert_(ds.cache.get(('other',) + key[1:]) is None)
+    def testEntityCacheDeferred(self):
+        ds = CachedDataSet(self.dsa, EntityCache())
+        ds.defer()
+        user = User.get(ds, 'usr2')
+        user.email = 'deferred'
+        user.save()
+        # read before the write reaches the datasource
+        self.assertEqual(User.get(ds, 'usr2').email, 'usr2@example.com')
+        ds.commit()
+        self.assertEqual(User.get(ds, 'usr2').email, 'deferred')
+        ds.defer(False)
     def testIn(self):
         ds = self.dsa
         usernames = [u.username for u in User.query(ds).filter('username', ['usr1','usr2','usr4'])]
@@ -188,6 +407,48 @@ class BaseTests(unittest.TestCase):
         closed = [t.id for t in Ticket.query(ds).filter('state', 'Closed')]
         self.assert_(set(open).issubset(set(closed)))
         self.assert_(Ticket.get(ds, open[0]).state == 'Closed')
+    def testUpdateExpression(self):
+        ds = self.dsa
+        Ticket.query(ds).filter('state', 'Open').update({'priority': F('priority') * 2 + 1, 'state': u'Hold'})
+        self.assertEqual([(t.id, t.priority, t.state) for t in Ticket.query(ds).order('id')],
+                [(1, 7, u'Hold'), (2, 7, u'Hold'), (3, 11, u'Hold'), (4, 3, u'Hold')])
+        self.assertEqual(Ticket.query(ds).filter('priority', 7).count(), 2)
+        # keys shifted onto each other's place
+        Ticket.query(ds).update({'id': F('id') + 1})
+        self.assertEqual([(t.id, t.priority) for t in Ticket.query(ds).order('id')],
+                [(2, 7), (3, 7), (4, 11), (5, 3)])
+        self.assert_(Ticket.get(ds, 1) is None)
+        self.assertEqual(Ticket.get(ds, 5).subject, u'Subj c')
+    def testCompactModel(self):
+        ds = self.dsa
+        user = CompactUser.get(ds, 'usr1')
+        self.assert_(not hasattr(user, '__dict__'))
+        self.assertEqual(user.full_name, u'user 1')
+        self.assertEqual(user['email'], u'usr1@example.com')
+        self.assertEqual(dict(user.data)['department'], u'a')
+        user.full_name = u'changed'
+        self.assertEqual(user.changed_props(), ['full_name'])
+        user.save()
+        self.assertEqual(User.get(ds, 'usr1').full_name, u'changed')
+        new = CompactUser(ds, username=u'usr9')
+        self.assertEqual(new.department, u'none')
+        self.assert_('email' not in new.data)
+        new.email = u'usr9@example.com'
+        new.cancel()
+        self.assertEqual(new.email, None)
+        agent = CompactAgent.get(ds, 'dir')
+        self.assertEqual((agent.full_name, agent.position), (u'Director', u'director'))
+        self.assertEqual(CompactAgent.query(ds).filter(position='manager').count(), 1)
+    def testModelMeta(self):
+        ds = self.dsa
+        meta = Agent._meta
+        self.assert_('position' in meta.props and 'email' in meta.props)
+        self.assertEqual(meta.key, ('username',))
+        self.assert_(meta.loader() is meta.loader())
+        agent = meta.loader(['username', 'position'])(ds, (u'clerk1', u'clerk'))
+        self.assert_(agent.saved)
+        self.assertEqual((agent.username, agent.position, agent.email), (u'clerk1', u'clerk', None))
+        self.assertEqual(GroupMember._meta.key, ('username', 'groupname'))
     def testModelInheritance(self):
         ds = self.dsa
         dir = Agent.get(ds, 'dir')
@@ -1,15 +1,36 @@
 
-from pyorm.memory_datasource import DataSet
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from pyorm.memory_datasource import DataSet, HashIndex, SortedIndex, ColumnarTable, convert_pickle
+from pyorm.memory_snapshot import is_snapshot
+from pyorm.cache import EntityCache, CachedDataSet
+from pyorm.fanout import FanOut
+from pyorm.shard import ShardedDataSet
+from pyorm.model import ORMError, Count, Sum, F
 import test_base
+from test_base import Ticket, User, GroupMember
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestDataSet(DataSet):
-    def __init__(self):
-        DataSet.__init__(self)
+    def __init__(self, **kwargs):
+        DataSet.__init__(self, **kwargs)
         self.id = 1
     def gen_id(self, gen_name):
         self.id += 1
         return self.id
 
+class NullConnection(object):
+    def rollback(self):
+        pass
+    def close(self):
+        pass
+
 class AllTests(test_base.BaseTests):
     def setUp(self):
         self.dsa = TestDataSet()
@@ -17,3 +38,302 @@ class AllTests(test_base.BaseTests):
     def tearDown(self):
         del self.dsa
 
+    def testIndexes(self):
+        ds = self.dsa
+        table = ds.get_table(Ticket)
+        table.add_index('assigned', 'hash')
+        table.add_index('priority', 'sorted')
+        self.assert_(isinstance(table.indexes['assigned'], HashIndex))
+        self.assert_(isinstance(table.indexes['priority'], SortedIndex))
+        self.assertEqual(sorted([t.id for t in Ticket.query(ds).filter('assigned', 'usr1')]), [1, 2])
+        self.assertEqual(sorted([t.id for t in Ticket.query(ds).filter('priority >', 3)]), [3])
+        self.assertEqual(Ticket.query(ds).filter('priority <=', 3).filter('assigned', 'usr2').count(), 1)
+        self.assertEqual([t.id for t in Ticket.query(ds).order('-priority')][0], 3)
+        tickets, token = Ticket.query(ds).order('-priority').page(2)
+        self.assertEqual([t.id for t in tickets], [3, 1])
+        tickets, token = Ticket.query(ds).filter('state', 'Open').order('-priority').page(2, after=token)
+        self.assertEqual(([t.id for t in tickets], token), ([2], None))
+        # indexes follow save and delete
+        ticket = Ticket.get(ds, 1)
+        ticket.assigned = 'usr3'
+        ticket.priority = 7
+        ticket.save()
+        self.assertEqual([t.id for t in Ticket.query(ds).filter('assigned', 'usr1')], [2])
+        self.assertEqual([t.id for t in Ticket.query(ds).filter('priority >', 5)], [1])
+        Ticket.get(ds, 2).delete()
+        self.assertEqual(Ticket.query(ds).filter('assigned', ['usr1', 'usr3']).count(), 1)
+        self.assertEqual(len(table.indexes['priority'].keys), 3)
+        # runs of equal values are ordered by key, bulk deletes keep the order
+        Ticket.save_many(ds, [Ticket(ds, id=i, state='Open', priority=i % 2 + 3) for i in range(100, 10, -1)])
+        index = table.indexes['priority']
+        self.assertEqual(zip(index.values, index.keys), sorted(zip(index.values, index.keys)))
+        Ticket.query(ds).filter('priority', 4).delete()
+        self.assertEqual(index.keys, [i for p, i in sorted([(t.priority, t.id) for t in Ticket.query(ds)])])
+        table.drop_index('priority')
+        self.assertEqual(table.add_index('priority', 'sorted').keys, index.keys)
+        # None sorts first and is never compared with a datetime
+        table.add_index('assigned', 'hash')
+        table.add_index('date_opened', 'sorted')
+        Ticket(ds, id=9, state='Open', assigned=u'usr9', date_opened=None).save()
+        self.assertEqual(table.indexes['date_opened'].keys[0], 9)
+        self.assertEqual(sorted([t.id for t in Ticket.query(ds).filter('date_opened <', datetime(2011,10,3))]), [1, 3])
+        self.assert_(9 in [t.id for t in Ticket.query(ds).filter('date_opened', None)])
+        self.assertEqual([t.id for t in Ticket.query(ds).filter('assigned', u'usr9')], [9])
+        # a record no index accepts leaves all of them unchanged
+        self.assertRaises(TypeError, Ticket(ds, id=10, state='Open', assigned=u'usr10', date_opened=5).save)
+        self.assertEqual(Ticket.query(ds).filter('assigned', u'usr10').count(), 0)
+        self.assert_(Ticket.get(ds, 10) is None)
+    def testFanOut(self):
+        tenants = {'t1': self.dsa, 't2': TestDataSet()}
+        self.populate_dataset(tenants['t2'])
+        Ticket(tenants['t2'], id=10, state=u'Open', subject=u'new', assigned=u'usr3',
+               date_opened=datetime(2011,10,5), priority=4).save()
+        fanout = FanOut(NullConnection, ['t1', 't2'], workers=2, union_limit=0,
+                        dataset_class=lambda con, schema: tenants[schema])
+        res = list(Ticket.query(fanout).filter('state', 'Open').order('-priority'))
+        self.assertEqual([t.priority for tenant, t in res], [5, 5, 4, 3, 3, 3, 3])
+        self.assertEqual((res[2][0], res[2][1].id), ('t2', 10))
+        self.assertEqual([t.priority for tenant, t in Ticket.query(fanout).order('-priority').fetch(2)], [5, 5])
+        self.assertEqual(Ticket.query(fanout).filter('state', 'Open').count(), 7)
+        self.assertEqual(Ticket.query(fanout).filter('state', 'Open').counts(), {'t1': 3, 't2': 4})
+        self.assertEqual(Ticket.query(fanout).aggregate(n=Count(), total=Sum('priority')), dict(n=9, total=32))
+        self.assertEqual(Ticket.query(fanout).group_by('assigned').aggregate(n=Count(), total=Sum('priority')),
+                [dict(assigned=u'usr1', n=4, total=12), dict(assigned=u'usr2', n=4, total=16),
+                 dict(assigned=u'usr3', n=1, total=4)])
+        # rows are streamed through queues of buffer_size models, also with
+        # fewer workers than tenants and when the reader stops early
+        for workers in (1, 2):
+            fanout = FanOut(NullConnection, ['t1', 't2', 't1'], workers=workers, union_limit=0,
+                            dataset_class=lambda con, schema: tenants[schema], buffer_size=1)
+            self.assertEqual([t.priority for tenant, t in Ticket.query(fanout).order('-priority')],
+                             [5, 5, 5, 4, 3, 3, 3, 3, 3, 3, 3, 3, 3])
+            self.assertEqual([tenant for tenant, t in Ticket.query(fanout)], ['t1'] * 4 + ['t2'] * 5 + ['t1'] * 4)
+            for item in Ticket.query(fanout).order('id'):
+                break
+            self.assertEqual(item[1].id, 1)
+    def testSharding(self):
+        shards = [TestDataSet(), TestDataSet(), TestDataSet()]
+        ds = ShardedDataSet(shards)
+        self.populate_dataset(ds)
+        self.assertEqual(sorted([Ticket.query(shard).count() for shard in shards]), [0, 1, 3])
+        self.assertEqual(ds.get(Ticket, 3).session, ds)
+        self.assert_(shards[ds.shard_index(Ticket, 3)].get(Ticket, 3) is not None)
+        self.assertEqual([t and t.id for t in Ticket.get_many(ds, [4, 9, 1])], [4, None, 1])
+        member = GroupMember.get(ds, (u'usr1', u'gr1'))
+        self.assertEqual(member.session, ds)
+        self.assertEqual(GroupMember.query(ds).count(), 4)
+        streamed = ShardedDataSet(shards, buffer_size=1)
+        self.assertEqual([t.id for t in Ticket.query(streamed).order('-priority,id')], [3, 1, 2, 4])
+        self.assertEqual(sorted([t.id for t in Ticket.query(streamed)]), [1, 2, 3, 4])
+        res = Ticket.query(ds).order('-priority,id').fetch(3)
+        self.assertEqual([t.id for t in res], [3, 1, 2])
+        self.assertEqual([t.id for t in Ticket.query(ds).order('id').fetch(2, offset=1)], [2, 3])
+        self.assertEqual([t.id for t in Ticket.query(ds).filter('state', 'Open').order('id')], [1, 2, 3])
+        self.assertEqual(Ticket.query(ds).aggregate(n=Count()), dict(n=4))
+        # a key change moves the model to the shard of the new key
+        ticket = Ticket.get(ds, 1)
+        for new_id in range(100, 200):
+            if ds.shard_index(Ticket, new_id) != ds.shard_index(Ticket, 1):
+                break
+        ticket.id = new_id
+        ticket.save()
+        self.assert_(Ticket.get(ds, 1) is None)
+        self.assertEqual(Ticket.get(ds, new_id).subject, ticket.subject)
+        self.assertEqual(Ticket.query(ds).count(), 4)
+        # saved again on its new shard only
+        self.assert_(not ticket.changed)
+        ticket.subject = u'moved'
+        ticket.save()
+        self.assertEqual(Ticket.get(ds, new_id).subject, u'moved')
+        self.assertEqual(Ticket.query(ds).count(), 4)
+        self.assertEqual(sum([Ticket.query(shard).filter('id', new_id).count() for shard in shards]), 1)
+        Ticket.query(ds).filter('state', 'Open').update({'priority': 1})
+        self.assertEqual(sorted([t.priority for t in Ticket.query(ds)]), [1, 1, 1, 3])
+        self.assertRaises(ORMError, Ticket.query(ds).update, {'id': F('id') + 10})
+        Ticket.query(ds).filter('priority', 1).delete()
+        self.assertEqual([t.id for t in Ticket.query(ds)], [4])
+        Ticket.get(ds, 4).delete()
+        self.assertEqual(Ticket.query(ds).count(), 0)
+    def testShardingGeneratedKeys(self):
+        shards = [DataSet(), DataSet()]
+        ds = ShardedDataSet(shards)
+        ids = iter(range(1, 100))
+        ds.gen_id = lambda gen_name: ids.next()
+        tickets = [Ticket(ds, state='Open') for i in range(6)]
+        Ticket.save_many(ds, tickets)
+        self.assertEqual([Ticket.get(ds, t.id).id for t in tickets], range(1, 7))
+        self.assert_(min([Ticket.query(shard).count() for shard in shards]) > 0)
+    def testJournal(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'data')
+            ds = DataSet(fn, journal=True)
+            test_base.populate_dataset(ds)
+            ds.commit()
+            self.assert_(not os.path.exists(fn))
+            log_size = os.path.getsize(fn + '.log')
+            user = User.get(ds, 'usr1')
+            user.email = 'journal@example.com'
+            user.save()
+            Ticket.get(ds, 4).delete()
+            ds.commit()
+            # the second commit appends only the changed rows
+            self.assert_(os.path.getsize(fn + '.log') - log_size < log_size)
+            User(ds, username='tmp').save()
+            ds.rollback()
+            self.assert_(User.get(ds, 'tmp') is None)
+            ds2 = DataSet(fn, journal=True)
+            self.assertEqual(User.get(ds2, 'usr1').email, 'journal@example.com')
+            self.assert_(Ticket.get(ds2, 4) is None)
+            self.assertEqual(Ticket.query(ds2).count(), 3)
+            # compaction folds the log into the snapshot
+            ds2.compact_size = 0
+            Ticket.get(ds2, 3).delete()
+            ds2.commit()
+            self.assertEqual(os.path.getsize(fn + '.log'), 0)
+            ds3 = DataSet(fn, journal=True)
+            self.assertEqual(Ticket.query(ds3).count(), 2)
+            self.assertEqual(User.get(ds3, 'usr1').email, 'journal@example.com')
+        finally:
+            shutil.rmtree(tmpdir)
+    def testEntityCacheRollback(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ds = DataSet(os.path.join(tmpdir, 'data'), journal=True)
+            test_base.populate_dataset(ds)
+            ds.commit()
+            cached = CachedDataSet(ds, EntityCache())
+            user = User.get(cached, 'usr1')
+            user.email = 'uncommitted'
+            user.save()
+            self.assertEqual(User.get(cached, 'usr1').email, 'uncommitted')
+            cached.rollback()
+            self.assertEqual(User.get(cached, 'usr1').email, 'usr1@example.com')
+            Ticket.query(cached).filter('state', 'Open').update({'priority': 1})
+            self.assertEqual(Ticket.get(cached, 1).priority, 1)
+            cached.rollback()
+            self.assertEqual(Ticket.get(cached, 1).priority, 3)
+        finally:
+            shutil.rmtree(tmpdir)
+    def testSnapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pickle_fn = os.path.join(tmpdir, 'data.pickle')
+            fn = os.path.join(tmpdir, 'data.snapshot')
+            ds = DataSet(pickle_fn)
+            test_base.populate_dataset(ds)
+            ds.get_table(Ticket).add_index('assigned', 'hash')
+            ds.commit()
+            convert_pickle(pickle_fn, fn)
+            self.assert_(is_snapshot(fn))
+            ds = DataSet(fn)
+            self.assertEqual(ds.data, {})
+            self.assertEqual(Ticket.query(ds).filter('assigned', 'usr1').count(), 2)
+            self.assertEqual(ds.data.keys(), [Ticket._table_name])
+            self.assert_(isinstance(ds.get_table(Ticket).indexes['assigned'], HashIndex))
+            Ticket.get(ds, 1).delete()
+            ds.commit()
+            ds = DataSet(fn, journal=True)
+            self.assertEqual(Ticket.query(ds).count(), 3)
+            self.assertEqual(User.get(ds, 'usr2').email, 'usr2@example.com')
+            User.get(ds, 'usr2').delete()
+            ds.commit()
+            ds.compact()
+            self.assert_(is_snapshot(fn))
+            ds = DataSet(fn, journal=True)
+            self.assert_(User.get(ds, 'usr2') is None)
+            self.assertEqual(User.query(ds).count(), 3)
+        finally:
+            shutil.rmtree(tmpdir)
+    def testEntityCacheLimits(self):
+        now = [0]
+        cache = EntityCache(max_entries=100, max_bytes=3000, ttl=10, clock=lambda: now[0])
+        ds = CachedDataSet(self.dsa, cache)
+        User.get(ds, 'usr1')
+        User.get(ds, 'usr1')
+        self.assertEqual(cache.stats()['hits'], 1)
+        now[0] = 11
+        User.get(ds, 'usr1')
+        self.assertEqual(cache.stats()['misses'], 2)
+        for username in ('usr2', 'usr3', 'usr4', 'dir', 'manager'):
+            User.get(ds, username)
+        self.assert_(cache.bytes <= 3000)
+        self.assert_(cache.stats()['evictions'] > 0)
+
+if numpy is not None:
+    class ColumnarTests(test_base.BaseTests):
+        def setUp(self):
+            self.dsa = TestDataSet(columnar=True)
+            self.populate_dataset(self.dsa)
+        def tearDown(self):
+            del self.dsa
+        def testColumnar(self):
+            ds = self.dsa
+            table = ds.get_table(Ticket)
+            self.assert_(isinstance(table, ColumnarTable))
+            modes = dict(zip(table.props, [c.mode for c in table.columns]))
+            self.assertEqual(modes['id'], 'int')
+            self.assertEqual(modes['state'], 'string')
+            self.assertEqual(modes['date_opened'], 'datetime')
+            # str and unicode values share the string mode
+            Ticket(ds, id=5, state='Open', priority=None).save()
+            self.assertEqual(table.columns[table.props.index('state')].mode, 'string')
+            self.assertEqual(Ticket.query(ds).filter('state', u'Open').count(), 4)
+            self.assertEqual(Ticket.query(ds).filter('priority', None).count(), 1)
+            self.assertEqual(Ticket.query(ds).filter('priority !=', None).count(), 4)
+            self.assertEqual(Ticket.query(ds).filter('priority >', 3).count(), 1)
+            self.assertEqual(Ticket.query(ds).filter('subject', None).count(), 1)
+            self.assertEqual(Ticket.query(ds).filter('date_opened <', datetime(2011,10,3)).count(), 2)
+            self.assertEqual(Ticket.query(ds).filter('id', [1, 5, 7]).count(), 2)
+            # a value of another type switches the column to objects
+            Ticket(ds, id='x', state=u'Hold').save()
+            self.assertEqual(table.columns[table.props.index('id')].mode, 'object')
+            self.assertEqual(Ticket.get(ds, 'x').state, u'Hold')
+            self.assertEqual(Ticket.query(ds).filter('state', 'Hold').count(), 2)
+            self.assertEqual(Ticket.get(ds, 2).date_opened, datetime(2011,10,3,12,01))
+            # ints and floats share a float column
+            column = table.columns[table.props.index('priority')]
+            Ticket(ds, id=6, state=u'Open', priority=2.5).save()
+            self.assertEqual(column.mode, 'float')
+            Ticket(ds, id=7, state=u'Open', priority=4).save()
+            self.assertEqual(column.mode, 'float')
+            self.assertEqual(sorted([t.id for t in Ticket.query(ds).filter('priority >', 3)]), [3, 7])
+            self.assertEqual(Ticket.get(ds, 1).priority, 3)
+            Ticket(ds, id=8, state=u'Open', priority=2**60).save()
+            self.assertEqual(column.mode, 'object')
+            self.assertEqual(Ticket.get(ds, 8).priority, 2**60)
+        def testSnapshotColumns(self):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                fn = os.path.join(tmpdir, 'data.snapshot')
+                ds = DataSet(fn, snapshot='mmap', columnar=True)
+                self.populate_dataset(ds)
+                Ticket(ds, id=5, state=u'Hold', subject=[1, 2], priority=None).save()
+                ds.get_table(Ticket).add_index('assigned', 'hash')
+                ds.commit()
+                ds = DataSet(fn, columnar=True)
+                self.assert_(ds.reader.is_columnar(Ticket._table_name))
+                table = ds.get_table(Ticket)
+                # fixed-width columns are used in place from the mapped file
+                column = table.columns[table.props.index('date_opened')]
+                self.assertFalse(column.values.flags.writeable)
+                self.assertFalse(table.columns[table.props.index('state')].values.flags.writeable)
+                self.assertEqual(table.columns[table.props.index('subject')].mode, 'object')
+                self.assertEqual(Ticket.query(ds).filter('state', 'Open').count(), 3)
+                self.assertEqual(Ticket.query(ds).filter('assigned', 'usr1').count(), 2)
+                self.assertEqual(Ticket.query(ds).filter('date_opened <', datetime(2011,10,3)).count(), 2)
+                self.assertEqual(Ticket.get(ds, 5).subject, [1, 2])
+                ticket = Ticket.get(ds, 2)
+                ticket.date_opened = datetime(2012,1,1)
+                ticket.save()
+                self.assert_(column.values.flags.writeable)
+                Ticket.get(ds, 1).delete()
+                ds.commit()
+                # row tables read columnar sections too
+                ds = DataSet(fn)
+                self.assertEqual(Ticket.query(ds).count(), 4)
+                self.assertEqual(Ticket.get(ds, 2).date_opened, datetime(2012,1,1))
+                self.assertEqual(Ticket.get(ds, 5).state, 'Hold')
+                self.assertEqual(Ticket.query(ds).filter('priority', None).count(), 1)
+            finally:
+                shutil.rmtree(tmpdir)
@@ -1,6 +1,11 @@
 
 import test_base
-from pyorm.pg_datasource import DataSet
+from pyorm.pg_datasource import DataSet, StatementCache
+from pyorm import async_pg_datasource
+from pyorm.fanout import FanOut
+from pyorm.pool import ConnectionPool, PoolTimeout
+from pyorm.shard import ShardedDataSet
+from select import select
 
 import psycopg2 as pg
 import psycopg2.extensions as ex
@@ -75,3 +80,114 @@ class AllTests(test_base.BaseTests):
         ds = self.dsa
         ticket = test_base.Ticket.query(ds).raw_filter('lower(subject)=%(subject)s', {'subject': 'subj a'}).fetchone()
         self.assert_(ticket.id == 2)
+    def testPreparedStatements(self):
+        ds = TestDataSet(self.con, 'orma', StatementCache(size=2))
+        self.assert_(test_base.User.get(ds, 'usr1').email == 'usr1@example.com')
+        self.assert_(test_base.User.get(ds, 'usr2').email == 'usr2@example.com')
+        self.assertEqual(ds.statements.stats()['hits'], 1)
+        user = test_base.User.get(ds, 'usr3')
+        user.email = 'prepared@example.com'
+        user.save()
+        self.assert_(test_base.Ticket.query(ds).filter('assigned', 'usr1').count() == 2)
+        self.assertEqual(ds.statements.stats()['evictions'], 1)
+        self.assert_(test_base.User.get(ds, 'usr3').email == 'prepared@example.com')
+        ds.set_schema('public')
+        self.assertEqual(ds.statements.stats()['size'], 0)
+    def testPreparedPaging(self):
+        ds = TestDataSet(self.con, 'orma', StatementCache(size=10))
+        query = test_base.Ticket.query(ds).order('id')
+        self.assertEqual([t.id for t in query.fetch(1, offset=1)], [2])
+        self.assertEqual([t.id for t in query.fetch(1, offset=2)], [3])
+        self.assertEqual(ds.statements.stats()['hits'], 1)
+        # a failed prepare is not cached
+        query = test_base.Ticket.query(ds).raw_filter('no_such_column = 1')
+        self.assertRaises(pg.ProgrammingError, query.count)
+        ds.rollback()
+        self.assertRaises(pg.ProgrammingError, query.count)
+        ds.rollback()
+        self.assertEqual(ds.statements.stats()['hits'], 1)
+    def testWaitCallback(self):
+        async_pg_datasource.install(lambda fd: select([fd], [], []), lambda fd: select([], [fd], []))
+        try:
+            ds = TestDataSet(pg.connect("dbname=pyorm_test"), 'orma')
+            self.assert_(test_base.User.get(ds, 'usr1').email == 'usr1@example.com')
+            self.assertEqual(test_base.Ticket.query(ds).filter('assigned', 'usr1').count(), 2)
+            # COPY is replaced by inserts
+            test_base.User.save_many(ds, [test_base.User(ds, username='async%d' % i) for i in range(3)])
+            ds.defer()
+            test_base.User(ds, username='async_deferred').save()
+            ds.commit()
+            names = ['async0', 'async1', 'async2', 'async_deferred']
+            self.assertEqual(test_base.User.query(ds).filter('username', names).count(), 4)
+            ds.con.close()
+        finally:
+            async_pg_datasource.uninstall()
+    def testFanOut(self):
+        ds = self.dsa
+        ds.execute(create_schema('ormb'))
+        self.populate_dataset(TestDataSet(self.con, 'ormb'))
+        ds.commit()
+        try:
+            for union_limit in (8, 0):
+                fanout = FanOut(lambda: pg.connect("dbname=pyorm_test"), ['orma', 'ormb'], union_limit=union_limit)
+                res = list(test_base.Ticket.query(fanout).filter('state', 'Open').order('-priority'))
+                self.assertEqual([t.priority for tenant, t in res], [5, 5, 3, 3, 3, 3])
+                self.assertEqual(sorted(set([tenant for tenant, t in res])), ['orma', 'ormb'])
+                self.assertEqual(test_base.Ticket.query(fanout).filter('state', 'Open').count(), 6)
+        finally:
+            ds.execute('drop schema ormb cascade')
+            ds.commit()
+    def testPool(self):
+        pool = ConnectionPool(lambda: pg.connect("dbname=pyorm_test"), min_size=1, max_size=2,
+                              timeout=0.1, statements_size=10)
+        with pool.dataset('orma') as ds:
+            user = test_base.User.get(ds, 'usr1')
+            user.email = 'pooled@example.com'
+            user.save()
+            ds.commit()
+        with pool.dataset('orma') as ds:
+            self.assertEqual(test_base.User.get(ds, 'usr1').email, 'pooled@example.com')
+            # uncommitted changes are rolled back on return
+            test_base.User.get(ds, 'usr2').delete()
+        with pool.dataset('orma') as ds:
+            ds.cursor().execute("set statement_timeout = 1234; create temp table pooled_tmp (id int)")
+            ds.commit()
+        with pool.dataset('orma') as ds:
+            # session state is reset on return
+            cur = ds.cursor()
+            cur.execute("show statement_timeout")
+            self.assertNotEqual(cur.fetchone()[0], '1234ms')
+            cur.execute("select count(*) from pg_tables where tablename = 'pooled_tmp'")
+            self.assertEqual(cur.fetchone()[0], 0)
+        # the first get of each view already runs prepared
+        self.assertEqual(pool.idle[-1].statements.stats()['hits'], 2)
+        first, second = pool.dataset('orma'), pool.dataset('orma')
+        self.assert_(test_base.User.get(first, 'usr2') is not None)
+        test_base.User.get(second, 'usr3')
+        self.assertRaises(PoolTimeout, test_base.User.get, pool.dataset('orma'), 'usr4')
+        first.close()
+        second.close()
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['in_use'], stats['peak_in_use'], stats['timeouts']), (2, 0, 2, 1))
+        pool.close()
+    def testSharding(self):
+        for schema in ('ormb', 'ormc'):
+            self.dsa.execute(create_schema(schema))
+        self.dsa.commit()
+        cons = [pg.connect("dbname=pyorm_test"), pg.connect("dbname=pyorm_test")]
+        ds = ShardedDataSet([TestDataSet(cons[0], 'ormb'), TestDataSet(cons[1], 'ormc')])
+        try:
+            self.populate_dataset(ds)
+            ds.commit()
+            self.assertEqual(test_base.Ticket.query(ds).count(), 4)
+            self.assertEqual(sorted([test_base.Ticket.query(shard).count() for shard in ds.shards]), [1, 3])
+            self.assertEqual([t.id for t in test_base.Ticket.query(ds).order('-priority,id').fetch(3)], [3, 1, 2])
+            self.assertEqual(test_base.GroupMember.get(ds, (u'usr4', u'gr2')).session, ds)
+            test_base.Ticket.query(ds).filter('state', 'Open').update({'priority': 1})
+            ds.commit()
+            self.assertEqual(sorted([t.priority for t in test_base.Ticket.query(ds)]), [1, 1, 1, 3])
+        finally:
+            for con in cons:
+                con.close()
+            self.dsa.execute('drop schema ormb cascade; drop schema ormc cascade')
+            self.dsa.commit()